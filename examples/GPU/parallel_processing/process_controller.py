@@ -3,6 +3,14 @@ Process lifecycle management controller, the main purpose of such controller wil
 
 Sample below only demonstrates the basic concept of how to manage the process lifecycle, it's not a complete solution, the real-world scenario will be more complex and need to consider more factors like the process resource limitation, the process priority, the process dependency, the process retry etc. it mainly focus on the process state transition and managament in parallel processing.
 
+Workers can run jobs in one of three modes:
+- process: a new child process per job, the state of the child is monitored until it exits
+- prefork: one long-lived child per worker receives jobs over a pipe, restarted if it dies
+- inline: the worker process runs the job itself, no fork at all
+For many short jobs the fork per job dominates, prefork keeps the isolation of a separate process without it and inline drops it entirely.
+Completion is event driven: the worker blocks on the child's sentinel (or pipe) and wakes as soon as the job ends. Sampling the child's state through psutil is optional, for observability only.
+A job's task is either a callable, run with the job's args and kwargs, or a plain value that gets the simulated work below. Whatever it returns, or the exception and traceback it raises, travels back to the worker (through the pipe for child processes) and from the worker to the controller through the result queue, together with every state change, so the controller's view of a job is the worker's.
+
 Below are Mermaid state diagram illustrating the transitions between these Linux process states:
 stateDiagram-v2
     [*] --> Running
@@ -15,10 +23,16 @@ stateDiagram-v2
     Stopped --> Running
     Zombie --> [*]
 """
+import argparse
+import copy
+import itertools
 import multiprocessing
+import multiprocessing.connection
+import pickle
 import queue
 import time
 import random
+import traceback
 import psutil
 from enum import Enum
 
@@ -29,19 +43,39 @@ class ProcessState(Enum):
     STOPPED = 'Stopped'
     ZOMBIE = 'Zombie'
 
+PSUTIL_STATES = {
+    psutil.STATUS_RUNNING: ProcessState.RUNNING,
+    psutil.STATUS_SLEEPING: ProcessState.INTERRUPTIBLE_SLEEP,
+    psutil.STATUS_DISK_SLEEP: ProcessState.UNINTERRUPTIBLE_SLEEP,
+    psutil.STATUS_STOPPED: ProcessState.STOPPED,
+    psutil.STATUS_ZOMBIE: ProcessState.ZOMBIE,
+}
+
 class Job:
-    def __init__(self, job_id, task):
+    def __init__(self, job_id, task, args=(), kwargs=None):
         self.job_id = job_id
         self.task = task
+        self.args = args
+        self.kwargs = kwargs or {}
         self.state = ProcessState.RUNNING
         self.result = None
         self.error = None
+        self.traceback = None
+
+WORKER_MODES = ("process", "prefork", "inline")
 
 class Worker(multiprocessing.Process):
-    def __init__(self, task_queue, result_queue):
+    def __init__(self, task_queue, result_queue, mode="process", sample_interval=None):
         super().__init__()
+        if mode not in WORKER_MODES:
+            raise ValueError(f"Unknown worker mode {mode}, expected one of {WORKER_MODES}")
         self.task_queue = task_queue
         self.result_queue = result_queue
+        self.mode = mode
+        # Seconds between psutil samples of a running child's state, None to never sample
+        self.sample_interval = sample_interval
+        self.child = None
+        self.conn = None
 
     def sim_run(self):
         while True:
@@ -81,78 +115,199 @@ class Worker(multiprocessing.Process):
                 self.result_queue.put(job)
 
     def run(self):
-        while True:
+        job = None
+        try:
+            while True:
+                try:
+                    # Blocks until a job or the None sentinel from stop() arrives
+                    job = self.task_queue.get()
+                    if job is None:
+                        break
+                    job.state = ProcessState.RUNNING
+                    self.publish(job)
+                    if self.mode == "inline":
+                        job = self.run_inline(job)
+                    elif self.mode == "prefork":
+                        job = self.run_prefork(job)
+                    else:
+                        job = self.run_in_process(job)
+                except BaseException as e:
+                    if job is not None and job.error is None:
+                        set_error(job, e)
+                    # An interrupt outside a task (e.g. Ctrl-C while waiting) still stops the worker, once the job is published as failed
+                    if not isinstance(e, Exception):
+                        raise
+                finally:
+                    if job is not None:
+                        job.state = ProcessState.ZOMBIE
+                        self.publish(job)
+                        job = None
+        finally:
+            self.stop_child()
+
+    def publish(self, job):
+        # Queue.put pickles in a background thread, so put a snapshot: later changes must not leak
+        # into it, and a result that cannot be pickled has to fail here rather than vanish there
+        try:
+            pickle.dumps(job.result)
+        except Exception as e:
+            job.result = None
+            set_error(job, e)
+        self.result_queue.put(copy.copy(job))
+
+    def run_in_process(self, job):
+        # Create a new process for the job, it sends the job back with its outcome over a pipe
+        conn, child_conn = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=self.serve_job, args=(job, child_conn))
+        process.start()
+        child_conn.close()
+
+        # The sentinel becomes ready the moment the process exits, the pipe when it replies
+        ready = self.wait_for(job, process.pid, conn, process.sentinel)
+        outcome = None
+        if conn in ready or conn.poll():
             try:
-                job = self.task_queue.get(timeout=1)
+                outcome = conn.recv()
+            except EOFError:
+                pass
+        process.join()
+        conn.close()
+        if outcome is None:
+            job.error = f"Job {job.job_id} process exited with code {process.exitcode} without a result"
+            return job
+        return outcome
 
-                # Create a new process for the job
-                process = multiprocessing.Process(target=self.process_job, args=(job,))
-                process.start()
-
-                # Monitor the process state
-                while True:
-                    try:
-                        status = psutil.Process(process.pid).status()
-                        if status == psutil.STATUS_RUNNING:
-                            job.state = ProcessState.RUNNING
-                        elif status == psutil.STATUS_SLEEPING:
-                            job.state = ProcessState.INTERRUPTIBLE_SLEEP
-                        elif status == psutil.STATUS_DISK_SLEEP:
-                            job.state = ProcessState.UNINTERRUPTIBLE_SLEEP
-                        elif status == psutil.STATUS_STOPPED:
-                            job.state = ProcessState.STOPPED
-                        elif status == psutil.STATUS_ZOMBIE:
-                            job.state = ProcessState.ZOMBIE
-                            break
-                        else:
-                            # Handle other states if needed
-                            pass
-
-                        time.sleep(1)
-
-                    except psutil.NoSuchProcess:
-                        # Process no longer exists
-                        break
+    def run_inline(self, job):
+        self.process_job(job)
+        return job
 
-                # Wait for the process to finish and get the result or error
-                process.join()
-                if job.error is None:
-                    job.result = f"Result for job {job.job_id}"
+    def run_prefork(self, job):
+        if self.child is None or not self.child.is_alive():
+            self.start_child()
+        try:
+            self.conn.send(job)
+            # Wakes on the reply, or on the child's sentinel if it dies without one
+            self.wait_for(job, self.child.pid, self.conn, self.child.sentinel)
+            job = self.conn.recv()
+        except (EOFError, OSError):
+            # The child died mid-job, the next job starts a fresh one
+            job.error = f"Worker child exited while running job {job.job_id}"
+            self.stop_child()
+        return job
 
-            except queue.Empty:
+    def wait_for(self, job, pid, *objects):
+        # Blocks until one of the connections or sentinels is ready, sampling the child every sample_interval meanwhile
+        while True:
+            ready = multiprocessing.connection.wait(objects, timeout=self.sample_interval)
+            if ready:
+                return ready
+            self.sample_state(job, pid)
+
+    def sample_state(self, job, pid):
+        try:
+            state = PSUTIL_STATES.get(psutil.Process(pid).status())
+        except psutil.NoSuchProcess:
+            # Exited between the wait and the sample, the next wait returns
+            return
+        if state is not None and state != job.state:
+            job.state = state
+            self.publish(job)
+
+    def start_child(self):
+        self.stop_child()
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.child = multiprocessing.Process(target=self.serve_jobs, args=(child_conn,), daemon=True)
+        self.child.start()
+        child_conn.close()
+
+    def stop_child(self):
+        if self.child is None:
+            return
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.child.join(timeout=5)
+        if self.child.is_alive():
+            self.child.terminate()
+            self.child.join()
+        self.conn.close()
+        self.child = self.conn = None
+
+    def serve_jobs(self, conn):
+        # Pre-forked child loop: one job in, the same job with its outcome out, until None arrives
+        while True:
+            try:
+                job = conn.recv()
+            except EOFError:
                 break
+            if job is None:
+                break
+            try:
+                self.process_job(job)
             finally:
-                self.result_queue.put(job)
+                send_job(conn, job)
+
+    def serve_job(self, job, conn):
+        # Per-job child: run it and send the outcome back before exiting
+        try:
+            self.process_job(job)
+        finally:
+            send_job(conn, job)
+            conn.close()
 
     def process_job(self, job):
         try:
+            if callable(job.task):
+                job.result = job.task(*job.args, **job.kwargs)
+                return job
             # Simulate job processing
             time.sleep(random.uniform(1, 5))
 
             # Simulate an error in some cases
             if random.random() < 0.1:
                 raise Exception(f"Job {job.job_id} encountered an error")
+            job.result = f"Result for job {job.job_id}: {job.task}"
 
-        except Exception as e:
-            job.error = str(e)
+        except BaseException as e:
+            # A task calling sys.exit or raising KeyboardInterrupt only fails its own job, the inline worker
+            # or pre-forked child running it stays up for the jobs queued behind it
+            set_error(job, e)
+        return job
+
+def set_error(job, error):
+    job.error = f"{type(error).__name__}: {error}"
+    job.traceback = "".join(traceback.format_exception(type(error), error, error.__traceback__))
+
+def send_job(conn, job):
+    try:
+        conn.send(job)
+    except Exception as e:
+        # The result (or the exception inside it) does not pickle, report that instead
+        job.result = None
+        set_error(job, e)
+        conn.send(job)
 
 class ProcessLifecycleController:
-    def __init__(self, num_workers):
+    def __init__(self, num_workers, mode="process", sample_interval=None):
         self.num_workers = num_workers
+        self.mode = mode
+        self.sample_interval = sample_interval
         self.task_queue = multiprocessing.Queue()
         self.result_queue = multiprocessing.Queue()
         self.jobs = {}
+        self.job_ids = itertools.count()
         self.workers = []
 
     def start(self):
         for _ in range(self.num_workers):
-            worker = Worker(self.task_queue, self.result_queue)
+            worker = Worker(self.task_queue, self.result_queue, self.mode, self.sample_interval)
             worker.start()
             self.workers.append(worker)
 
-    def submit_job(self, task):
-        job_id = len(self.jobs)
-        job = Job(job_id, task)
+    def submit_job(self, task, *args, **kwargs):
+        job_id = next(self.job_ids)
+        job = Job(job_id, task, args, kwargs)
         self.jobs[job_id] = job
         self.task_queue.put(job)
         return job_id
@@ -175,60 +330,87 @@ class ProcessLifecycleController:
             return job.error
         return None
 
-    def monitor_jobs(self):
-        completed_jobs = []
+    def get_job_traceback(self, job_id):
+        job = self.jobs.get(job_id)
+        if job and job.state == ProcessState.ZOMBIE:
+            return job.traceback
+        return None
+
+    def monitor_jobs(self, timeout=1):
+        # Applies the updates workers published since the last call, waiting up to `timeout` for the
+        # first one, and returns the ids of the jobs that finished
+        finished = []
         while True:
             try:
-                job = self.result_queue.get(timeout=1)
-                if job.state == ProcessState.ZOMBIE:
-                    if job.error is None:
-                        completed_jobs.append(job.job_id)
-                    else:
-                        print(f"Job {job.job_id} failed: {job.error}")
-                        if job.job_id in self.jobs:
-                            del self.jobs[job.job_id]
+                job = self.result_queue.get(timeout=timeout) if timeout else self.result_queue.get_nowait()
             except queue.Empty:
                 break
-        
-        for job_id in completed_jobs:
-            if job_id in self.jobs:
-                del self.jobs[job_id]
+            timeout = 0
+            if job.job_id not in self.jobs:
+                # Released already
+                continue
+            self.jobs[job.job_id] = job
+            if job.state == ProcessState.ZOMBIE:
+                finished.append(job.job_id)
+                if job.error is not None:
+                    print(f"Job {job.job_id} failed: {job.error}")
+        return finished
+
+    def release_job(self, job_id):
+        # Forget a job once its outcome has been read
+        return self.jobs.pop(job_id, None)
 
-    def stop(self):
+    def stop(self, timeout=5):
+        # One sentinel per worker, each exits once it finishes the jobs queued ahead of it
+        for _ in self.workers:
+            self.task_queue.put(None)
         for worker in self.workers:
-            worker.terminate()
+            worker.join(timeout=timeout)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
         self.workers.clear()
 
 # Usage example
 if __name__ == "__main__":
-    controller = ProcessLifecycleController(num_workers=5)
+    parser = argparse.ArgumentParser(description="Process lifecycle controller demo")
+    parser.add_argument("--mode", choices=WORKER_MODES, default="process", help="how workers run their jobs")
+    parser.add_argument("--workers", type=int, default=5)
+    parser.add_argument("--sample-interval", type=float, default=None,
+                        help="seconds between psutil samples of a running job's process state, off by default")
+    args = parser.parse_args()
+
+    controller = ProcessLifecycleController(num_workers=args.workers, mode=args.mode, sample_interval=args.sample_interval)
     controller.start()
 
-    # Submit jobs
-    job_ids = []
-    for i in range(10):
-        job_id = controller.submit_job(f"Task {i}")
-        job_ids.append(job_id)
-
-    # Monitor job status and results
-    while job_ids:
-        for job_id in job_ids:
-            status = controller.get_job_status(job_id)
-            print(f"Job {job_id} status: {status}")
-            if status == ProcessState.ZOMBIE:
-                result = controller.get_job_result(job_id)
-                if result is not None:
-                    print(f"Job {job_id} completed. Result: {result}")
-                    job_ids.remove(job_id)
-                else:
+    # stop() also runs on Ctrl-C, its sentinels let the workers exit instead of blocking on the queue
+    try:
+        # Submit jobs
+        job_ids = []
+        for i in range(10):
+            job_id = controller.submit_job(f"Task {i}")
+            job_ids.append(job_id)
+
+        # Callables run for real, their return value or exception comes back
+        job_ids.append(controller.submit_job(pow, 2, 10))
+        job_ids.append(controller.submit_job(int, "not a number"))
+
+        # Monitor job status and results
+        while job_ids:
+            controller.monitor_jobs()
+            for job_id in list(job_ids):
+                status = controller.get_job_status(job_id)
+                print(f"Job {job_id} status: {status}")
+                if status == ProcessState.ZOMBIE:
                     error = controller.get_job_error(job_id)
-                    print(f"Job {job_id} failed. Error: {error}")
+                    if error is None:
+                        print(f"Job {job_id} completed. Result: {controller.get_job_result(job_id)}")
+                    else:
+                        print(f"Job {job_id} failed. Error: {error}\n{controller.get_job_traceback(job_id)}")
+                    controller.release_job(job_id)
+                    job_ids.remove(job_id)
+                elif status is None:
+                    print(f"Job {job_id} status is None")
                     job_ids.remove(job_id)
-            elif status is None:
-                print(f"Job {job_id} status is None")
-                job_ids.remove(job_id)
-        
-        controller.monitor_jobs()
-        time.sleep(1)
-
-    controller.stop()
+    finally:
+        controller.stop()
@@ -0,0 +1,45 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from process_controller import ProcessLifecycleController
+
+
+def interrupt():
+    raise KeyboardInterrupt("interrupted by the task")
+
+
+def wait_finished(controller, job_ids, timeout=30):
+    finished = set()
+    deadline = time.monotonic() + timeout
+    while not finished.issuperset(job_ids) and time.monotonic() < deadline:
+        finished.update(controller.monitor_jobs(timeout=0.1))
+    return finished
+
+
+class InterruptedJobTest(unittest.TestCase):
+    def check_mode(self, mode):
+        controller = ProcessLifecycleController(num_workers=1, mode=mode)
+        controller.start()
+        try:
+            interrupted = controller.submit_job(interrupt)
+            healthy = [controller.submit_job(pow, 2, i) for i in range(3)]
+            finished = wait_finished(controller, [interrupted] + healthy)
+            self.assertEqual(finished, {interrupted, *healthy})
+            self.assertTrue(controller.get_job_error(interrupted).startswith("KeyboardInterrupt"))
+            self.assertEqual([controller.get_job_result(job_id) for job_id in healthy], [1, 2, 4])
+            self.assertTrue(all(controller.get_job_error(job_id) is None for job_id in healthy))
+        finally:
+            controller.stop()
+
+    def test_prefork_child_survives_interrupted_job(self):
+        self.check_mode("prefork")
+
+    def test_inline_worker_survives_interrupted_job(self):
+        self.check_mode("inline")
+
+
+if __name__ == "__main__":
+    unittest.main()
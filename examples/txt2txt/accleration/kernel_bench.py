@@ -0,0 +1,314 @@
+"""
+Reusable kernel benchmark harness.
+
+A suite (e.g. "matmul") knows how to build inputs for a shape and dtype, the reference
+result and the FLOP count. Kernels register against a suite with a name, a setup function
+that prepares their state (device copies, compiled modules, tuned parameters) from the
+inputs and a run function that computes the result. The harness does warmup, timing,
+checking against the reference within RTOL/ATOL, statistics (mean, std, median, min,
+TFLOPS) and writes JSON or CSV results, so every kernel experiment produces comparable
+numbers. Suites that know their memory traffic also get a roofline classification: the
+arithmetic intensity (FLOPs per byte moved) of each shape against the machine balance
+(peak FLOPs / peak bandwidth, measured once per device and dtype) tells whether the shape
+is memory-bandwidth-bound or compute-bound. Compare a run against a stored baseline with:
+
+    python kernel_bench.py compare results.json baseline.json --threshold 0.05
+"""
+import argparse
+import csv
+import json
+import platform
+import sys
+import time
+from typing import List, Dict, Any
+
+import numpy as np
+import torch
+
+RTOL = 1e-2
+ATOL = 1e-2
+
+SUITES = {}
+KERNELS = {}
+
+PEAKS = {}  # (device, dtype) -> {"tflops": ..., "gbps": ...}
+
+RESULT_FIELDS = ["suite", "kernel", "device", "shape", "dtype", "status", "iterations",
+                 "mean_ms", "std_ms", "median_ms", "min_ms", "tflops", "gbps", "bytes", "intensity", "bound", "max_abs_diff"]
+NUMERIC_FIELDS = ["iterations", "mean_ms", "std_ms", "median_ms", "min_ms", "tflops", "gbps", "bytes", "intensity", "max_abs_diff"]
+
+class Suite:
+    def __init__(self, name: str, make_inputs, reference, flops, traffic=None):
+        self.name = name
+        self.make_inputs = make_inputs  # (shape, dtype) -> dict of CPU tensors
+        self.reference = reference      # inputs -> expected result as a CPU tensor
+        self.flops = flops              # shape -> floating point operations of one run
+        self.traffic = traffic          # (shape, itemsize) -> minimum bytes read and written by one run
+
+class Kernel:
+    def __init__(self, suite: str, name: str, run, setup=None, device: str = "cpu", available=None, fetch=None, dtypes=None,
+                 traffic=None):
+        self.suite = suite
+        self.name = name
+        self.run = run              # state -> result
+        self.setup = setup          # inputs -> state, the inputs themselves by default
+        self.device = device
+        self.available = available  # () -> bool, checked before setup
+        self.fetch = fetch          # (state, result) -> tensor comparable with the reference
+        self.dtypes = dtypes        # supported dtype names, all of them by default
+        self.traffic = traffic      # (shape, itemsize) -> bytes this implementation moves, the suite minimum by default
+
+    def is_available(self, dtype: str = None) -> bool:
+        if self.device == "cuda" and not torch.cuda.is_available():
+            return False
+        if dtype is not None and self.dtypes is not None and dtype not in self.dtypes:
+            return False
+        return self.available is None or self.available()
+
+def register_suite(name: str, make_inputs, reference, flops, traffic=None) -> Suite:
+    SUITES[name] = Suite(name, make_inputs, reference, flops, traffic)
+    return SUITES[name]
+
+def register_kernel(suite: str, name: str, run, setup=None, device: str = "cpu", available=None, fetch=None, dtypes=None,
+                    traffic=None) -> Kernel:
+    kernel = Kernel(suite, name, run, setup, device, available, fetch, dtypes, traffic)
+    KERNELS[(suite, device, name)] = kernel
+    return kernel
+
+def suite_kernels(suite: str, device: str = None, names=None) -> List[Kernel]:
+    return [
+        kernel for (kernel_suite, kernel_device, name), kernel in KERNELS.items()
+        if kernel_suite == suite and (device is None or kernel_device == device) and (names is None or name in names)
+    ]
+
+def shape_name(shape) -> str:
+    return "x".join(str(dim) for dim in shape)
+
+def as_cpu_tensor(value) -> torch.Tensor:
+    if isinstance(value, np.ndarray):
+        value = torch.from_numpy(value)
+    return value.detach().to("cpu", torch.float64)
+
+def _best_time(fn, synchronize, repeats: int = 5) -> float:
+    fn()
+    synchronize()
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        synchronize()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def measure_peaks(device: str, dtype: str = "float32") -> Dict[str, float]:
+    """
+    Best-effort machine balance: peak throughput of a large torch.mm in `dtype` and peak
+    bandwidth of a large tensor copy. Cached per (device, dtype); call set_peaks first to
+    use datasheet numbers instead.
+    """
+    if (device, dtype) in PEAKS:
+        return PEAKS[(device, dtype)]
+    synchronize = torch.cuda.synchronize if device == "cuda" else (lambda: None)
+    n = 8192 if device == "cuda" else 1024
+    a = torch.randn(n, n, device=device).to(getattr(torch, dtype))
+    b = torch.randn(n, n, device=device).to(getattr(torch, dtype))
+    tflops = 2 * n ** 3 * 1e-12 / _best_time(lambda: torch.mm(a, b), synchronize)
+    src = torch.empty(64 * 2 ** 20 if device == "cuda" else 32 * 2 ** 20, device=device)
+    dst = torch.empty_like(src)
+    # A copy reads and writes every byte once
+    gbps = 2 * src.numel() * src.element_size() * 1e-9 / _best_time(lambda: dst.copy_(src), synchronize)
+    return set_peaks(device, dtype, tflops, gbps)
+
+def set_peaks(device: str, dtype: str, tflops: float, gbps: float) -> Dict[str, float]:
+    PEAKS[(device, dtype)] = {"tflops": tflops, "gbps": gbps}
+    return PEAKS[(device, dtype)]
+
+def roofline(suite: str, shape, dtype: str, device: str) -> Dict[str, Any]:
+    # A shape whose FLOPs per byte falls below the ridge point (peak FLOPs / peak bandwidth) is memory-bound
+    traffic = SUITES[suite].traffic
+    if traffic is None:
+        return {}
+    intensity = SUITES[suite].flops(shape) / traffic(shape, getattr(torch, dtype).itemsize)
+    peaks = measure_peaks(device, dtype)
+    ridge = peaks["tflops"] * 1e12 / (peaks["gbps"] * 1e9)
+    return {"intensity": intensity, "ridge": ridge, "bound": "memory" if intensity < ridge else "compute"}
+
+def benchmark(kernel: Kernel, shape, dtype: str, inputs, reference, warmup: int = 10, iterations: int = 100,
+              rtol: float = RTOL, atol: float = ATOL, verify_every: int = 10) -> Dict[str, Any]:
+    # Times `iterations` runs after `warmup` ones, checking the result on the first and every `verify_every`-th run
+    result = {"suite": kernel.suite, "kernel": kernel.name, "device": kernel.device, "shape": shape_name(shape),
+              "dtype": dtype, "iterations": 0}
+    if not kernel.is_available(dtype):
+        result["status"] = "unavailable"
+        if kernel.is_available():
+            result["error"] = f"no {dtype} support"
+        return result
+    synchronize = torch.cuda.synchronize if kernel.device == "cuda" else (lambda: None)
+    try:
+        state = kernel.setup(inputs) if kernel.setup is not None else inputs
+        for _ in range(warmup):
+            kernel.run(state)
+        synchronize()
+
+        times = []
+        max_abs_diff = 0.0
+        for i in range(iterations):
+            start = time.perf_counter()
+            output = kernel.run(state)
+            synchronize()
+            times.append((time.perf_counter() - start) * 1e3)
+            if i % verify_every == 0:
+                actual = as_cpu_tensor(kernel.fetch(state, output) if kernel.fetch is not None else output)
+                max_abs_diff = max(max_abs_diff, (actual - reference).abs().max().item())
+                if not torch.allclose(actual, reference, rtol=rtol, atol=atol):
+                    result.update(status="mismatch", iterations=i + 1, max_abs_diff=max_abs_diff)
+                    return result
+    except Exception as e:
+        result.update(status="error", error=str(e))
+        return result
+
+    mean = float(np.mean(times))
+    suite = SUITES[kernel.suite]
+    result.update(
+        status="ok", iterations=iterations, mean_ms=mean, std_ms=float(np.std(times)),
+        median_ms=float(np.median(times)), min_ms=float(np.min(times)),
+        tflops=suite.flops(shape) * 1e-12 / (mean * 1e-3), max_abs_diff=max_abs_diff,
+    )
+    traffic = kernel.traffic or suite.traffic
+    if traffic is not None:
+        result["bytes"] = traffic(shape, getattr(torch, dtype).itemsize)
+        result["gbps"] = result["bytes"] * 1e-9 / (mean * 1e-3)
+    return result
+
+def run_suite(suite: str, shapes, dtypes=("float32",), device: str = None, kernels=None, verbose: bool = True, **options) -> List[Dict[str, Any]]:
+    # Inputs and the reference are built once per (shape, dtype) and shared by every kernel
+    results = []
+    for shape in shapes:
+        for dtype in dtypes:
+            candidates = suite_kernels(suite, device, kernels)
+            devices = sorted({kernel.device for kernel in candidates if kernel.is_available(dtype)})
+            bounds = {kernel_device: roofline(suite, shape, dtype, kernel_device) for kernel_device in devices}
+            if verbose:
+                print(f"\nBenchmarking {suite} {shape_name(shape)} {dtype}")
+                for kernel_device, bound in bounds.items():
+                    if bound:
+                        print(f"  {kernel_device}: {bound['intensity']:.1f} FLOP/byte, ridge {bound['ridge']:.1f}, {bound['bound']}-bound")
+            inputs = SUITES[suite].make_inputs(shape, getattr(torch, dtype))
+            reference = as_cpu_tensor(SUITES[suite].reference(inputs))
+            for kernel in candidates:
+                result = benchmark(kernel, shape, dtype, inputs, reference, **options)
+                bound = bounds.get(kernel.device)
+                if bound:
+                    result.update(intensity=bound["intensity"], bound=bound["bound"])
+                results.append(result)
+                if verbose:
+                    print_result(result)
+    return results
+
+def print_result(result: Dict[str, Any], unit: str = None):
+    name = result["kernel"]
+    if result["status"] != "ok":
+        reason = result.get("error") or {"unavailable": "not available here", "mismatch": "verification failed"}[result["status"]]
+        detail = f", max abs diff {result['max_abs_diff']:.3g}" if result["status"] == "mismatch" else ""
+        print(f"{name:>10} - skipped, {reason}{detail}")
+        return
+    # GFLOPS reads better for CPU kernels, TFLOPS for GPU ones
+    unit = unit or ("TFLOPS" if result["device"] == "cuda" else "GFLOPS")
+    throughput = result["tflops"] * (1 if unit == "TFLOPS" else 1e3)
+    bandwidth = f", {result['gbps']:>7.1f} GB/s" if result.get("gbps") is not None else ""
+    print(f"{name:>10} - Mean: {result['mean_ms']:>8.2f} ms (±{result['std_ms']:>6.2f}), {throughput:>6.2f} {unit}{bandwidth}")
+
+def print_best(results: List[Dict[str, Any]]):
+    # One line per (suite, shape, dtype, device): the roofline class and the fastest kernel by median time
+    best = {}
+    for result in results:
+        if result["status"] != "ok":
+            continue
+        key = (result["suite"], result["shape"], result["dtype"], result["device"])
+        if key not in best or result["median_ms"] < best[key]["median_ms"]:
+            best[key] = result
+    print("\nFastest kernel per shape:")
+    for (suite, shape, dtype, device), result in best.items():
+        bound = f"{result['bound']}-bound" if result.get("bound") else ""
+        print(f"{suite:<26} {shape:<18} {dtype:<9} {device:<5} {bound:<15} {result['kernel']:<10} {result['median_ms']:>9.3f} ms")
+
+def write_results(results: List[Dict[str, Any]], path: str):
+    if path.endswith(".csv"):
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(results)
+        return
+    meta = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "host": platform.node(), "processor": platform.processor(),
+        "python": platform.python_version(), "torch": torch.__version__, "numpy": np.__version__,
+        "cuda": torch.cuda.get_device_name() if torch.cuda.is_available() else None,
+        "peaks": {f"{device}/{dtype}": peaks for (device, dtype), peaks in PEAKS.items()},
+    }
+    with open(path, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=2)
+
+def load_results(path: str) -> List[Dict[str, Any]]:
+    if path.endswith(".csv"):
+        with open(path, newline="") as f:
+            rows = list(csv.DictReader(f))
+        for row in rows:
+            for field in NUMERIC_FIELDS:
+                row[field] = float(row[field]) if row.get(field) not in (None, "") else None
+        return rows
+    with open(path) as f:
+        return json.load(f)["results"]
+
+def result_key(result) -> tuple:
+    return (result["suite"], result["kernel"], result["device"], result["shape"], result["dtype"])
+
+def compare_results(current, baseline, threshold: float = 0.05) -> List[Dict[str, Any]]:
+    """
+    Matches results by (suite, kernel, device, shape, dtype) and returns one row per kernel
+    measured in both runs. A row is a regression when its median time grew by more than
+    `threshold` (relative) or it passed in the baseline and no longer does.
+    """
+    baseline_by_key = {result_key(result): result for result in baseline}
+    rows = []
+    for result in current:
+        base = baseline_by_key.get(result_key(result))
+        if base is None:
+            continue
+        row = {"key": result_key(result), "baseline_ms": base.get("median_ms"), "current_ms": result.get("median_ms"),
+               "status": result["status"], "change": None, "regression": False}
+        if result["status"] == "ok" and base["status"] == "ok":
+            row["change"] = result["median_ms"] / base["median_ms"] - 1
+            row["regression"] = row["change"] > threshold
+        elif base["status"] == "ok":
+            row["regression"] = True
+        rows.append(row)
+    return rows
+
+def print_comparison(rows):
+    for row in rows:
+        suite, kernel, device, shape, dtype = row["key"]
+        label = f"{suite} {kernel} {device} {shape} {dtype}"
+        if row["change"] is None:
+            print(f"{label:<50} {row['status']:>12}{'  REGRESSION' if row['regression'] else ''}")
+        else:
+            print(f"{label:<50} {row['baseline_ms']:>9.3f} -> {row['current_ms']:>9.3f} ms ({row['change']:>+7.1%})"
+                  f"{'  REGRESSION' if row['regression'] else ''}")
+
+def check_regressions(results, baseline_path: str, threshold: float) -> bool:
+    # Prints the comparison and returns True when nothing regressed
+    rows = compare_results(results, load_results(baseline_path), threshold)
+    print(f"\nComparison against {baseline_path} (threshold {threshold:.0%}):")
+    print_comparison(rows)
+    regressions = sum(row["regression"] for row in rows)
+    print(f"{regressions} regression(s) in {len(rows)} comparable result(s)")
+    return regressions == 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    compare = subcommands.add_parser("compare", help="flag regressions of a results file against a baseline")
+    compare.add_argument("results")
+    compare.add_argument("baseline")
+    compare.add_argument("--threshold", type=float, default=0.05, help="relative slowdown of the median time that counts as a regression")
+    args = parser.parse_args()
+    sys.exit(0 if check_regressions(load_results(args.results), args.baseline, args.threshold) else 1)
@@ -1,58 +1,1416 @@
+import argparse
 import asyncio
+import bisect
+import contextvars
+import itertools
+import json
 import time
 import logging
+import os
+import socket
+import struct
+import tempfile
 from functools import wraps
 from typing import List, Dict, Any
-from transformers import DistilBertTokenizer, DistilBertForMaskedLM
 import torch
+import torch.nn.functional as F
 import hashlib
-from collections import OrderedDict
+import sys
+import threading
+from collections import OrderedDict, deque
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Load the DistilBERT model and tokenizer
-tokenizer = DistilBertTokenizer.from_pretrained('distilbert-base-uncased')
-model = DistilBertForMaskedLM.from_pretrained('distilbert-base-uncased', output_hidden_states=True)
+class ModelHandle:
+    """
+    Process-wide DistilBERT model and tokenizer, each loaded on first use instead of at import,
+    so code that never runs the model (cache, transport, scheduling) does not pay for it and
+    every node in the process shares one copy. configure() picks the checkpoint and CPU
+    inference options before loading: a reduced `dtype` such as torch.bfloat16, `quantize`
+    for int8 dynamic quantization of the Linear layers, and `inference_mode` to run forwards
+    under torch.inference_mode instead of torch.no_grad.
+    """
+    def __init__(self, name: str = 'distilbert-base-uncased'):
+        self.name = name
+        self.dtype = None
+        self.quantize = False
+        self.inference_mode = False
+        self._model = None
+        self._tokenizer = None
+        self._config = None
+        self.lock = threading.Lock()
 
-def timing_decorator(func):
-    @wraps(func)
-    async def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = await func(*args, **kwargs)
-        end_time = time.time()
-        logger.info(f"{func.__name__} took {end_time - start_time:.4f} seconds")
-        return result
-    return wrapper
+    def configure(self, name: str = None, dtype=None, quantize: bool = None, inference_mode: bool = None):
+        dtype = getattr(torch, dtype) if isinstance(dtype, str) else dtype
+        requested = ((name, self.name), (dtype, self.dtype), (quantize, self.quantize))
+        if self._model is not None and any(value is not None and value != current for value, current in requested):
+            raise RuntimeError("Model is already loaded, configure it before first use")
+        if name is not None and name != self.name:
+            self.name = name
+            self._config = None
+        if dtype is not None:
+            self.dtype = dtype
+        if quantize is not None:
+            self.quantize = quantize
+        if inference_mode is not None:
+            self.inference_mode = inference_mode
+        if self.quantize and self.dtype not in (None, torch.float32):
+            raise ValueError("int8 dynamic quantization needs a float32 model")
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            with self.lock:
+                if self._tokenizer is None:
+                    from transformers import DistilBertTokenizer
+                    self._tokenizer = DistilBertTokenizer.from_pretrained(self.name)
+        return self._tokenizer
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self.lock:
+                if self._model is None:
+                    from transformers import DistilBertForMaskedLM
+                    self._model = self.prepare(DistilBertForMaskedLM.from_pretrained(self.name, output_hidden_states=True))
+        return self._model
+
+    @property
+    def config(self):
+        # Only the small config file when the weights are not needed yet
+        if self._model is not None:
+            return self._model.config
+        if self._config is None:
+            from transformers import DistilBertConfig
+            self._config = DistilBertConfig.from_pretrained(self.name)
+        return self._config
+
+    def prepare(self, model):
+        model = model.eval()
+        if self.dtype is not None:
+            model = model.to(self.dtype)
+        if self.quantize:
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        logger.info(f"Loaded {type(model).__name__} ({self.dtype or torch.float32}{', int8 dynamic' if self.quantize else ''})")
+        return model
+
+    def set(self, model=None, tokenizer=None):
+        # Swap in an already built model (prepared with the configured options) or tokenizer
+        if model is not None:
+            self._model = self.prepare(model)
+        if tokenizer is not None:
+            self._tokenizer = tokenizer
+
+    def grad_mode(self):
+        return torch.inference_mode() if self.inference_mode else torch.no_grad()
+
+class LazyAttribute:
+    # Module-level stand-in that forwards attribute access and calls to an attribute of `owner`
+    def __init__(self, owner, name: str):
+        self._owner = owner
+        self._name = name
+
+    def __getattr__(self, attribute):
+        return getattr(getattr(self._owner, self._name), attribute)
+
+    def __call__(self, *args, **kwargs):
+        return getattr(self._owner, self._name)(*args, **kwargs)
+
+model_handle = ModelHandle()
+tokenizer = LazyAttribute(model_handle, "tokenizer")
+model = LazyAttribute(model_handle, "model")
+
+# Request the current coroutine/thread works for, picked up by every span opened under it
+current_request_id = contextvars.ContextVar("current_request_id", default=None)
+
+class RingBufferSink:
+    # Keeps the last `capacity` spans in memory
+    def __init__(self, capacity: int = 10000):
+        self.spans = deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.spans.append(record)
+
+    def close(self):
+        pass
+
+class JSONLSink:
+    def __init__(self, path: str):
+        self.file = open(path, "a")
+        self.lock = threading.Lock()
+
+    def emit(self, record):
+        line = json.dumps(record, default=str) + "\n"
+        with self.lock:
+            self.file.write(line)
+
+    def close(self):
+        self.file.close()
+
+class ChromeTraceSink:
+    # Complete ("X") events loadable in chrome://tracing or Perfetto, written on close
+    def __init__(self, path: str):
+        self.path = path
+        self.events = []
+
+    def emit(self, record):
+        args = {name: value for name, value in record.items() if name not in ("name", "start_ns", "duration_ns", "thread")}
+        self.events.append({
+            "name": record["name"], "ph": "X", "pid": os.getpid(), "tid": record["thread"],
+            "ts": record["start_ns"] / 1e3, "dur": record["duration_ns"] / 1e3, "args": args,
+        })
+
+    def close(self):
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": self.events}, f, default=str)
+
+class Span:
+    __slots__ = ("sink", "name", "attrs", "start_ns")
+
+    def __init__(self, sink, name, attrs):
+        self.sink = sink
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+        return self
+
+    def __enter__(self):
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration_ns = time.perf_counter_ns() - self.start_ns
+        record = {"name": self.name, "start_ns": self.start_ns, "duration_ns": duration_ns,
+                  "thread": threading.get_ident(), "request_id": current_request_id.get()}
+        record.update(self.attrs)
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+        self.sink.emit(record)
+        return False
+
+class NullSpan:
+    # Shared no-op span returned while tracing is disabled
+    def set(self, **attrs):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Tracer:
+    """
+    Per-stage spans (tokenize, cache lookup, model forward, KV transfer, decode step, ...)
+    timed with the monotonic perf_counter_ns clock. Each span records the current request
+    ID plus any attributes such as token counts and goes to a pluggable sink. Without a sink
+    `span` hands back a shared no-op object, so disabled tracing costs one attribute check.
+    Attributes that take work to compute are passed as `attrs`, a callable returning a dict,
+    and only evaluated when the span is recorded.
+    """
+    def __init__(self, sink=None):
+        self.sink = sink
+
+    @property
+    def enabled(self):
+        return self.sink is not None
+
+    def set_sink(self, sink):
+        previous, self.sink = self.sink, sink
+        if previous is not None:
+            previous.close()
+
+    def span(self, name, attrs=None, **values):
+        if self.sink is None:
+            return NULL_SPAN
+        if attrs is not None:
+            values.update(attrs())
+        return Span(self.sink, name, values)
+
+tracer = Tracer()
+
+def traced(name):
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def ewma(average, sample, alpha=0.2):
+    return sample if average is None else (1 - alpha) * average + alpha * sample
+
+# kv_data entry carrying the prompt's per-layer keys/values from prefill to decode
+PROMPT_KV_KEY = "prompt_past_key_values"
+
+def prompt_kv_key(request_id) -> str:
+    # Requests share a decoding node's inbox, so each prompt is transferred under its own key
+    return f"{PROMPT_KV_KEY}/{request_id}"
+
+def forward_with_past(input_ids, past_key_values=None, attention_mask=None, position_ids=None):
+    with model_handle.grad_mode():
+        return _forward_with_past(input_ids, past_key_values, attention_mask, position_ids)
+
+def _forward_with_past(input_ids, past_key_values=None, attention_mask=None, position_ids=None):
+    """
+    Runs DistilBERT layer by layer with a per-layer key/value cache, which the HF model does
+    not expose since it is an encoder. `past_key_values` has shape (n_layers, 2, batch,
+    past_len, dim). `attention_mask` covers past plus new positions, either per key
+    (batch, past_len + seq_len) with 1 for real tokens, or per query and key (batch, seq_len,
+    past_len + seq_len). By default new tokens attend to every cached position and to each
+    other, so a prompt is encoded bidirectionally and every later step only costs
+    O(past_len). `position_ids` (batch, seq_len) defaults to continuing after the past.
+    Returns (logits, last hidden states, past_key_values extended by the new positions).
+    """
+    distilbert = model.distilbert
+    embeddings = distilbert.embeddings
+    batch_size, seq_len = input_ids.shape
+    dim = model.config.dim
+    n_heads = model.config.n_heads
+    past_len = 0 if past_key_values is None else past_key_values.size(-2)
+
+    if position_ids is None:
+        position_ids = torch.arange(past_len, past_len + seq_len, device=input_ids.device).unsqueeze(0)
+    hidden = embeddings.word_embeddings(input_ids) + embeddings.position_embeddings(position_ids)
+    hidden = embeddings.dropout(embeddings.LayerNorm(hidden))
+    mask = None
+    if attention_mask is not None:
+        mask = (attention_mask[:, None, None, :] if attention_mask.dim() == 2 else attention_mask[:, None]).bool()
+
+    def split_heads(x):
+        return x.view(batch_size, -1, n_heads, dim // n_heads).transpose(1, 2)
+
+    new_past = []
+    for i, layer in enumerate(distilbert.transformer.layer):
+        attention = layer.attention
+        key = attention.k_lin(hidden)
+        value = attention.v_lin(hidden)
+        if past_key_values is not None:
+            key = torch.cat([past_key_values[i, 0], key], dim=1)
+            value = torch.cat([past_key_values[i, 1], value], dim=1)
+        new_past.append(torch.stack([key, value]))
+
+        attention_output = F.scaled_dot_product_attention(
+            split_heads(attention.q_lin(hidden)), split_heads(key), split_heads(value), attn_mask=mask)
+        attention_output = attention.out_lin(attention_output.transpose(1, 2).reshape(batch_size, seq_len, dim))
+        attention_output = layer.sa_layer_norm(attention_output + hidden)
+        hidden = layer.output_layer_norm(layer.ffn(attention_output) + attention_output)
+
+    logits = model.vocab_projector(model.vocab_layer_norm(model.activation(model.vocab_transform(hidden))))
+    return logits, hidden, torch.stack(new_past)
+
+# Word -> word piece ids, filled on first sight so shared prefixes and repeated words are tokenized once
+_word_pieces = {}
+
+def word_piece_ids(words) -> List[List[int]]:
+    missing = [word for word in dict.fromkeys(words) if word not in _word_pieces]
+    if missing:
+        # WordPiece splits words independently, so tokenizing them one per sequence matches is_split_into_words
+        for word, pieces in zip(missing, tokenizer(missing, add_special_tokens=False)["input_ids"]):
+            _word_pieces[word] = pieces
+    return [_word_pieces[word] for word in words]
+
+def prompt_encoding(input_tokens) -> tuple:
+    """
+    Returns the prompt's token ids, [CLS] followed by its word pieces ([SEP] is left out since
+    generation continues the sequence), and per word the position of its first piece, plus
+    the total length as a last entry, all clipped to the truncated length. Word k's pieces
+    are token_ids[word_starts[k]:word_starts[k + 1]].
+    """
+    # The config alone, tokenizing must not load the weights
+    max_len = model_handle.config.max_position_embeddings
+    with tracer.span("tokenize", lambda: {"words": len(input_tokens)}) as span:
+        token_ids = [tokenizer.cls_token_id]
+        word_starts = []
+        for pieces in word_piece_ids(input_tokens):
+            word_starts.append(len(token_ids))
+            token_ids.extend(pieces)
+        token_ids = token_ids[:max_len]
+        word_starts = [min(start, len(token_ids)) for start in word_starts] + [len(token_ids)]
+        if tracer.enabled:
+            span.set(tokens=len(token_ids))
+    return token_ids, word_starts
+
+def encode_suffixes(batch) -> List[torch.Tensor]:
+    """
+    Encodes each request's uncached token ids on top of its cached prefix keys/values in one
+    right-padded forward. `batch` holds (prefix keys/values (n_layers, 2, prefix_len, dim) or
+    None, token ids, block index per token id). Attention is block causal: a token sees the
+    whole prefix, its own block and earlier blocks, never a later one, so every block's
+    keys/values depend only on the chain of blocks before it and can be reused under its
+    chain key. Returns the new keys/values (n_layers, 2, len(token_ids), dim) per request.
+    """
+    past_lens = [0 if past is None else past.size(-2) for past, _, _ in batch]
+    max_past = max(past_lens)
+    max_new = max(len(token_ids) for _, token_ids, _ in batch)
+    max_position = model.config.max_position_embeddings - 1
+
+    input_ids = torch.full((len(batch), max_new), tokenizer.pad_token_id, dtype=torch.long)
+    position_ids = torch.zeros((len(batch), max_new), dtype=torch.long)
+    attention_mask = torch.zeros((len(batch), max_new, max_past + max_new), dtype=torch.bool)
+    past_key_values = None
+    if max_past:
+        reference = next(past for past in (past for past, _, _ in batch) if past is not None)
+        past_key_values = reference.new_zeros(reference.shape[:2] + (len(batch), max_past, reference.size(-1)))
+    for i, ((past, token_ids, block_ids), past_len) in enumerate(zip(batch, past_lens)):
+        num_new = len(token_ids)
+        input_ids[i, :num_new] = torch.tensor(token_ids, dtype=torch.long)
+        position_ids[i] = torch.arange(past_len, past_len + max_new).clamp(max=max_position)
+        if past_len:
+            past_key_values[:, :, i, :past_len] = past
+            attention_mask[i, :, :past_len] = True
+        blocks = torch.tensor(block_ids, dtype=torch.long)
+        attention_mask[i, :num_new, max_past:max_past + num_new] = blocks[None, :] <= blocks[:, None]
+        # Padding queries attend to themselves only, so no softmax row is empty
+        padding = torch.arange(num_new, max_new)
+        attention_mask[i, padding, max_past + padding] = True
+    with tracer.span("model_forward", lambda: {"batch": len(batch), "tokens": sum(len(token_ids) for _, token_ids, _ in batch)}, stage="prefill"):
+        _, _, new_past = forward_with_past(input_ids, past_key_values, attention_mask, position_ids)
+    return [new_past[:, :, i, max_past:max_past + len(token_ids)].clone() for i, (_, token_ids, _) in enumerate(batch)]
+
+# Pieces per word a KV block page is sized for, a block with more is not cached
+KV_PIECES_PER_WORD = 4
+
+def kv_block_rows(window_size: int, pieces_per_word: int = KV_PIECES_PER_WORD) -> int:
+    # Rows of `dim` values in one cached block: keys and values of every layer for its word pieces
+    return model_handle.config.n_layers * 2 * window_size * pieces_per_word
+
+def entry_nbytes(value) -> int:
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    return sys.getsizeof(value)
+
+class DictStorage:
+    # Default backend, values are kept as the objects handed to put
+    def fits(self, value):
+        return True
+
+    def can_store(self, value):
+        return True
+
+    def write(self, value):
+        return value
+
+    def read(self, handle):
+        return handle
+
+    def take(self, handle):
+        return handle
+
+    def free(self, handle):
+        pass
+
+class BlockPoolStorage:
+    """
+    Keeps KV entries in one preallocated contiguous arena of fixed-size pages instead of
+    per-entry Python objects. Each entry occupies one page of up to `page_tokens` rows of
+    `hidden_size` values (any tensor whose last dimension is `hidden_size`, its leading
+    dimensions flattened into rows, e.g. a block's per-layer keys and values), pages are
+    recycled through a free list, and reads return views into the arena rather than copies.
+    A view is only valid until its entry is evicted or overwritten, so views stay inside the
+    cache: anything handing values on (TieredKVCache, the prefill node) clones them first.
+    """
+    def __init__(self, num_pages: int, page_tokens: int, hidden_size: int, dtype=torch.float32, device='cpu'):
+        self.arena = torch.zeros((num_pages, page_tokens, hidden_size), dtype=dtype, device=device)
+        self.page_tokens = page_tokens
+        self.hidden_size = hidden_size
+        self.free_pages = list(range(num_pages - 1, -1, -1))
+
+    def fits(self, value):
+        value = torch.as_tensor(value)
+        return value.dim() >= 1 and value.size(-1) == self.hidden_size and value.numel() <= self.page_tokens * self.hidden_size
+
+    def can_store(self, value):
+        return len(self.free_pages) > 0
+
+    def write(self, value):
+        value = torch.as_tensor(value, dtype=self.arena.dtype)
+        if not self.fits(value):
+            raise ValueError(f"Entry of shape {tuple(value.shape)} does not fit a ({self.page_tokens}, {self.hidden_size}) page")
+        rows = value.numel() // self.hidden_size
+        page = self.free_pages.pop()
+        self.arena[page, :rows].copy_(value.reshape(rows, self.hidden_size))
+        return (page, tuple(value.shape))
+
+    def read(self, handle):
+        page, shape = handle
+        rows = 1
+        for size in shape[:-1]:
+            rows *= size
+        return self.arena[page, :rows].view(shape)
+
+    def take(self, handle):
+        # Owned copy for an entry leaving the pool, its page is reused right after
+        value = self.read(handle).clone()
+        self.free(handle)
+        return value
+
+    def free(self, handle):
+        self.free_pages.append(handle[0])
+
+class DiskStorage:
+    """
+    Cold-tier backend: a preallocated file of `num_slots` fixed-size byte slots, memory-mapped
+    with torch.from_file so reads are views served from the page cache / local NVMe rather
+    than deserialized copies. Any tensor up to `slot_bytes` fits a slot.
+    """
+    def __init__(self, path: str, num_slots: int, slot_bytes: int):
+        with open(path, "ab") as f:
+            f.truncate(num_slots * slot_bytes)
+        self.path = path
+        self.slot_bytes = slot_bytes
+        self.arena = torch.from_file(path, shared=True, size=num_slots * slot_bytes, dtype=torch.uint8).view(num_slots, slot_bytes)
+        self.free_slots = list(range(num_slots - 1, -1, -1))
+
+    def fits(self, value):
+        return entry_nbytes(torch.as_tensor(value)) <= self.slot_bytes
+
+    def can_store(self, value):
+        return len(self.free_slots) > 0
+
+    def write(self, value):
+        value = torch.as_tensor(value).detach().cpu().contiguous()
+        nbytes = entry_nbytes(value)
+        if nbytes > self.slot_bytes:
+            raise ValueError(f"Entry of {nbytes} bytes does not fit a {self.slot_bytes} byte slot")
+        slot = self.free_slots.pop()
+        self.arena[slot, :nbytes].copy_(value.reshape(-1).view(torch.uint8))
+        return (slot, value.dtype, tuple(value.shape), nbytes)
+
+    def read(self, handle):
+        slot, dtype, shape, nbytes = handle
+        return self.arena[slot, :nbytes].view(dtype).reshape(shape)
+
+    def take(self, handle):
+        value = self.read(handle).clone()
+        self.free(handle)
+        return value
+
+    def free(self, handle):
+        self.free_slots.append(handle[0])
+
+# KV snapshot file: the entries' raw tensor bytes back to back, each padded to SNAPSHOT_ALIGNMENT,
+# then a JSON index (key, dtype, shape, offset, nbytes per entry, plus free-form metadata), then
+# SNAPSHOT_TRAILER (index bytes, magic). Written to a temporary file and renamed into place, so a
+# reader only ever sees a complete snapshot.
+SNAPSHOT_MAGIC = b"MCKS"
+SNAPSHOT_TRAILER = struct.Struct("!Q4s")
+SNAPSHOT_ALIGNMENT = 64
+
+class KVSnapshotWriter:
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.file = open(self.tmp_path, "wb")
+        self.entries = []
+        self.keys = set()
+        self.offset = 0
+
+    def add(self, key, value):
+        if key in self.keys:
+            return
+        if not isinstance(value, torch.Tensor):
+            logger.warning(f"Skipping non-tensor KV entry {key!r} in snapshot")
+            return
+        value = value.detach().cpu().contiguous()
+        payload = value.reshape(-1).view(torch.uint8).numpy()
+        self.file.write(payload)
+        padding = -payload.nbytes % SNAPSHOT_ALIGNMENT
+        self.file.write(bytes(padding))
+        self.entries.append({"key": key, "dtype": str(value.dtype).split(".")[-1], "shape": list(value.shape),
+                             "offset": self.offset, "nbytes": payload.nbytes})
+        self.keys.add(key)
+        self.offset += payload.nbytes + padding
+
+    def close(self, metadata=None):
+        index = json.dumps({"entries": self.entries, "metadata": metadata or {}}).encode()
+        self.file.write(index)
+        self.file.write(SNAPSHOT_TRAILER.pack(len(index), SNAPSHOT_MAGIC))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+        logger.info(f"Wrote {len(self.entries)} KV entries, {self.offset / 2**20:.2f} MiB to snapshot {self.path}")
+
+class KVSnapshot:
+    """
+    Read-only view of a snapshot file. Only the index is parsed on open, the arena is
+    memory-mapped privately with torch.from_file, so an entry's pages are faulted in from the
+    page cache / disk on first read rather than deserialized up front. Reads are views into
+    the mapping.
+    """
+    def __init__(self, path: str):
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            f.seek(size - SNAPSHOT_TRAILER.size)
+            index_bytes, magic = SNAPSHOT_TRAILER.unpack(f.read(SNAPSHOT_TRAILER.size))
+            if magic != SNAPSHOT_MAGIC:
+                raise ValueError(f"{path} is not a KV snapshot")
+            f.seek(size - SNAPSHOT_TRAILER.size - index_bytes)
+            index = json.loads(f.read(index_bytes))
+        self.path = path
+        self.arena = torch.from_file(path, shared=False, size=size, dtype=torch.uint8)
+        self.entries = {entry["key"]: entry for entry in index["entries"]}
+        self.metadata = index["metadata"]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        return list(self.entries)
+
+    def read(self, key):
+        entry = self.entries[key]
+        payload = self.arena[entry["offset"]:entry["offset"] + entry["nbytes"]]
+        return payload.view(getattr(torch, entry["dtype"])).reshape(entry["shape"])
+
+    def discard(self, key):
+        # Entry superseded by a newer value or taken out of the cache
+        self.entries.pop(key, None)
+
+class LRUPolicy:
+    def __init__(self):
+        self.order = OrderedDict()
+
+    def record_insert(self, key):
+        self.order[key] = None
+
+    def record_access(self, key):
+        self.order.move_to_end(key)
+
+    def record_remove(self, key):
+        self.order.pop(key, None)
+
+    def victim(self, incoming_key=None):
+        key, _ = self.order.popitem(last=False)
+        return key
+
+class LFUPolicy:
+    # O(1) LFU: keys bucketed by access count, least recently used first inside a bucket
+    def __init__(self):
+        self.counts = {}
+        self.buckets = {}
+        self.min_count = 0
+
+    def _bucket_remove(self, key):
+        count = self.counts[key]
+        bucket = self.buckets[count]
+        bucket.pop(key)
+        if not bucket:
+            del self.buckets[count]
+            if self.min_count == count:
+                self.min_count = count + 1
+
+    def record_insert(self, key):
+        self.counts[key] = 1
+        self.buckets.setdefault(1, OrderedDict())[key] = None
+        self.min_count = 1
+
+    def record_access(self, key):
+        self._bucket_remove(key)
+        self.counts[key] += 1
+        self.buckets.setdefault(self.counts[key], OrderedDict())[key] = None
+
+    def record_remove(self, key):
+        if key in self.counts:
+            self._bucket_remove(key)
+            del self.counts[key]
+            if self.counts and self.min_count not in self.buckets:
+                self.min_count = min(self.buckets)
+
+    def victim(self, incoming_key=None):
+        key = next(iter(self.buckets[self.min_count]))
+        self.record_remove(key)
+        return key
+
+class ARCPolicy:
+    """
+    Adaptive Replacement Cache (Megiddo & Modha). T1 holds keys seen once recently, T2 keys
+    seen at least twice; B1/B2 remember keys recently evicted from each, and a re-insert of a
+    ghost shifts the target size `p` of T1 towards whichever list would have kept it. The
+    cache size is taken as the current resident count since capacity may be in bytes.
+    """
+    def __init__(self):
+        self.t1, self.t2 = OrderedDict(), OrderedDict()
+        self.b1, self.b2 = OrderedDict(), OrderedDict()
+        self.p = 0
+
+    def _size(self):
+        return max(len(self.t1) + len(self.t2), 1)
+
+    def record_insert(self, key):
+        size = self._size()
+        if key in self.b1:
+            self.p = min(size, self.p + max(len(self.b2) // max(len(self.b1), 1), 1))
+            del self.b1[key]
+            self.t2[key] = None
+        elif key in self.b2:
+            self.p = max(0, self.p - max(len(self.b1) // max(len(self.b2), 1), 1))
+            del self.b2[key]
+            self.t2[key] = None
+        else:
+            self.t1[key] = None
+        for ghosts in (self.b1, self.b2):
+            while len(ghosts) > size:
+                ghosts.popitem(last=False)
+
+    def record_access(self, key):
+        self.t1.pop(key, None)
+        self.t2.pop(key, None)
+        self.t2[key] = None
+
+    def record_remove(self, key):
+        self.t1.pop(key, None)
+        self.t2.pop(key, None)
+
+    def victim(self, incoming_key=None):
+        if self.t1 and (len(self.t1) > self.p or (incoming_key in self.b2 and len(self.t1) == self.p) or not self.t2):
+            key, _ = self.t1.popitem(last=False)
+            self.b1[key] = None
+        else:
+            key, _ = self.t2.popitem(last=False)
+            self.b2[key] = None
+        return key
+
+class PrefixAwarePolicy:
+    """
+    LRU restricted to blocks with no resident children, so a parent block is never evicted
+    before the blocks chained below it (which would be unreachable without it). Needs the
+    RadixTree the keys come from, a PrefillNode binds its own tree on construction.
+    """
+    def __init__(self, tree=None):
+        self.tree = tree
+        self.order = OrderedDict()
+        # Parent key of every resident block, taken from the tree when it is inserted: the tree may
+        # drop a node (and its subtree) before the cache evicts it
+        self.parent_of = {}
+        # Key -> resident blocks chained directly below it, kept even while the key itself is not resident
+        self.resident_children = {}
+
+    def bind_tree(self, tree):
+        self.tree = tree
+
+    def _parent_key(self, key):
+        node = self.tree.nodes_by_key.get(key) if self.tree is not None else None
+        return node.parent.key if node is not None and node.parent is not None else None
+
+    def record_insert(self, key):
+        self.order[key] = None
+        parent_key = self._parent_key(key)
+        self.parent_of[key] = parent_key
+        if parent_key is not None:
+            self.resident_children.setdefault(parent_key, set()).add(key)
+
+    def record_access(self, key):
+        self.order.move_to_end(key)
+
+    def record_remove(self, key):
+        if key in self.order:
+            del self.order[key]
+            parent_key = self.parent_of.pop(key)
+            children = self.resident_children.get(parent_key)
+            if children is not None:
+                children.discard(key)
+                if not children:
+                    del self.resident_children[parent_key]
+
+    def victim(self, incoming_key=None):
+        # Any resident forest has a leaf, so this always finds a candidate
+        key = next(key for key in self.order if not self.resident_children.get(key))
+        self.record_remove(key)
+        return key
+
+EVICTION_POLICIES = {"lru": LRUPolicy, "lfu": LFUPolicy, "arc": ARCPolicy, "prefix": PrefixAwarePolicy}
 
 class KVCache:
-    def __init__(self, capacity: int):
-        self.cache = OrderedDict()
+    def __init__(self, capacity: int, storage=None, capacity_bytes: int = None, policy="lru"):
+        # key -> storage handle
+        self.cache = {}
         self.capacity = capacity
+        self.capacity_bytes = capacity_bytes
+        self.storage = storage if storage is not None else DictStorage()
+        self.policy = EVICTION_POLICIES[policy]() if isinstance(policy, str) else policy
+        # Bytes held by each entry and in total, checked against capacity_bytes
+        self.entry_bytes = {}
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Entries too large for a storage slot, never stored
+        self.oversized = 0
+        # Coroutine called with (key, owned value) for every evicted entry, used for tier demotion
+        self.on_evict = None
+        # KVSnapshot reopened by load_snapshot, served lazily behind the live entries
+        self.snapshot = None
 
-    def _hash_key(self, key):
-        return hashlib.sha256(key.encode()).hexdigest()
+    def __contains__(self, key):
+        return key in self.cache or (self.snapshot is not None and key in self.snapshot)
 
-    async def get(self, key):
-        hashed_key = self._hash_key(key)
-        if hashed_key not in self.cache:
+    def snapshot_items(self):
+        # Live entries in the policy's order, then whatever was never touched from a loaded snapshot
+        for key in list(self.cache):
+            yield key, self.storage.read(self.cache[key])
+        if self.snapshot is not None:
+            for key in self.snapshot.keys():
+                yield key, self.snapshot.read(key)
+
+    def save_snapshot(self, path: str, metadata=None):
+        writer = KVSnapshotWriter(path)
+        for key, value in self.snapshot_items():
+            writer.add(key, value)
+        writer.close(metadata)
+
+    def load_snapshot(self, path: str) -> KVSnapshot:
+        # Entries stay in the mapped file and do not count against capacity; a put or pop of
+        # the same key supersedes the snapshot copy
+        self.snapshot = KVSnapshot(path)
+        return self.snapshot
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.cache), "bytes": self.size_bytes,
+            "hits": self.hits, "misses": self.misses, "evictions": self.evictions, "oversized": self.oversized,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "snapshot_entries": len(self.snapshot) if self.snapshot is not None else 0,
+        }
+
+    def _is_full(self, value, nbytes):
+        if len(self.cache) >= self.capacity or not self.storage.can_store(value):
+            return True
+        return self.capacity_bytes is not None and self.size_bytes + nbytes > self.capacity_bytes
+
+    def _remove(self, key):
+        handle = self.cache.pop(key)
+        self.size_bytes -= self.entry_bytes.pop(key)
+        return handle
+
+    # Keys are expected to be RadixTree chain keys (or other unique strings) already,
+    # so get/put use them as-is instead of hashing a second time. The _get/_pop/_put cores
+    # never await, which lets ShardedKVCache wrap them in plain locks.
+    def _get(self, key):
+        if key not in self.cache:
+            if self.snapshot is not None and key in self.snapshot:
+                self.hits += 1
+                return self.snapshot.read(key)
+            self.misses += 1
             return None
-        value = self.cache.pop(hashed_key)
-        self.cache[hashed_key] = value
-        return value
+        self.hits += 1
+        self.policy.record_access(key)
+        return self.storage.read(self.cache[key])
+
+    def _pop(self, key):
+        if key not in self.cache:
+            if self.snapshot is not None and key in self.snapshot:
+                value = self.snapshot.read(key).clone()
+                self.snapshot.discard(key)
+                return value
+            return None
+        self.policy.record_remove(key)
+        return self.storage.take(self._remove(key))
+
+    def _put(self, key, value) -> List[tuple]:
+        # Returns the evicted (key, value) pairs for the caller to demote
+        if self.snapshot is not None:
+            self.snapshot.discard(key)
+        if key in self.cache:
+            self.policy.record_remove(key)
+            self.storage.free(self._remove(key))
+        if not self.storage.fits(value):
+            # Evicting could not make room for it, so it is simply not cached
+            self.oversized += 1
+            return []
+        nbytes = entry_nbytes(value)
+        evicted = []
+        while self.cache and self._is_full(value, nbytes):
+            evicted_key = self.policy.victim(key)
+            evicted.append((evicted_key, self.storage.take(self._remove(evicted_key))))
+            self.evictions += 1
+        self.cache[key] = self.storage.write(value)
+        self.entry_bytes[key] = nbytes
+        self.size_bytes += nbytes
+        self.policy.record_insert(key)
+        return evicted
+
+    async def _demote(self, evicted):
+        if self.on_evict is not None:
+            for evicted_key, evicted_value in evicted:
+                await self.on_evict(evicted_key, evicted_value)
+
+    async def get(self, key):
+        return self._get(key)
+
+    async def pop(self, key):
+        return self._pop(key)
 
     async def put(self, key, value):
-        hashed_key = self._hash_key(key)
-        if hashed_key in self.cache:
-            self.cache.pop(hashed_key)
-        elif len(self.cache) >= self.capacity:
-            self.cache.popitem(last=False)
-        self.cache[hashed_key] = value
+        await self._demote(self._put(key, value))
+
+    async def get_many(self, keys) -> List[Any]:
+        return [self._get(key) for key in keys]
+
+    async def put_many(self, items):
+        for key, value in items:
+            await self.put(key, value)
+
+class ShardedKVCache:
+    """
+    KVCache split into `num_shards` independent shards picked by key hash, each guarded by
+    its own threading.Lock. Locks are only held around the synchronous cache cores, never
+    across an await, so the cache is safe to share between asyncio tasks and a thread pool
+    (through the *_sync methods) and concurrent requests only contend on the same shard.
+    Batch operations take each involved shard's lock once.
+
+    `policy` is an eviction policy name or a factory, every shard gets its own instance.
+    PrefixAwarePolicy is not supported: the blocks of a chain hash into different shards, so
+    no shard could tell whether a block still has resident children.
+    """
+    def __init__(self, num_shards: int, capacity: int, storage_factory=None, capacity_bytes: int = None, policy="lru"):
+        policy_factory = EVICTION_POLICIES[policy] if isinstance(policy, str) else policy
+        if not callable(policy_factory):
+            raise TypeError("ShardedKVCache needs a policy name or factory, a policy instance would be shared by all shards")
+        shard_capacity = -(-capacity // num_shards)
+        shard_bytes = None if capacity_bytes is None else -(-capacity_bytes // num_shards)
+        self.shards = [
+            KVCache(shard_capacity, storage_factory() if storage_factory is not None else None, shard_bytes, policy_factory())
+            for _ in range(num_shards)
+        ]
+        if isinstance(self.shards[0].policy, PrefixAwarePolicy):
+            raise ValueError("Prefix-aware eviction needs a whole chain in one cache, use a KVCache instead of ShardedKVCache")
+        self.locks = [threading.Lock() for _ in range(num_shards)]
+
+    @property
+    def on_evict(self):
+        return self.shards[0].on_evict
+
+    @on_evict.setter
+    def on_evict(self, callback):
+        for shard in self.shards:
+            shard.on_evict = callback
+
+    def _shard_index(self, key):
+        return hash(key) % len(self.shards)
+
+    def _group(self, keys):
+        groups = {}
+        for position, key in enumerate(keys):
+            groups.setdefault(self._shard_index(key), []).append(position)
+        return groups
+
+    def __contains__(self, key):
+        return key in self.shards[self._shard_index(key)]
+
+    def snapshot_items(self):
+        # Each shard's live entries are copied out under its own lock, so the snapshot is consistent per shard
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                items = [(key, value.clone() if isinstance(value, torch.Tensor) else value)
+                         for key, value in ((key, shard.storage.read(handle)) for key, handle in shard.cache.items())]
+            yield from items
+        # The loaded snapshot is shared by all shards, so its untouched entries are yielded once. The
+        # owning shard's lock guards against the entry being taken meanwhile, the mapping itself is read-only
+        snapshot = self.shards[0].snapshot
+        if snapshot is not None:
+            for key in snapshot.keys():
+                with self.locks[self._shard_index(key)]:
+                    value = snapshot.read(key) if key in snapshot else None
+                if value is not None:
+                    yield key, value
+
+    def save_snapshot(self, path: str, metadata=None):
+        writer = KVSnapshotWriter(path)
+        for key, value in self.snapshot_items():
+            writer.add(key, value)
+        writer.close(metadata)
+
+    def load_snapshot(self, path: str) -> KVSnapshot:
+        # One shared snapshot is enough, a key is only ever looked up in its own shard
+        snapshot = KVSnapshot(path)
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                shard.snapshot = snapshot
+        return snapshot
+
+    def stats(self) -> Dict[str, Any]:
+        shard_stats = []
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                shard_stats.append(shard.stats())
+        totals = {name: sum(stats[name] for stats in shard_stats) for name in ("entries", "bytes", "hits", "misses", "evictions", "oversized")}
+        totals["snapshot_entries"] = shard_stats[0]["snapshot_entries"]
+        lookups = totals["hits"] + totals["misses"]
+        totals["hit_ratio"] = totals["hits"] / lookups if lookups else 0.0
+        return totals
+
+    def get_sync(self, key):
+        index = self._shard_index(key)
+        with self.locks[index]:
+            return self.shards[index]._get(key)
+
+    def pop_sync(self, key):
+        index = self._shard_index(key)
+        with self.locks[index]:
+            return self.shards[index]._pop(key)
+
+    def put_sync(self, key, value) -> List[tuple]:
+        index = self._shard_index(key)
+        with self.locks[index]:
+            return self.shards[index]._put(key, value)
+
+    def get_many_sync(self, keys) -> List[Any]:
+        keys = list(keys)
+        values = [None] * len(keys)
+        for index, positions in self._group(keys).items():
+            with self.locks[index]:
+                for position in positions:
+                    values[position] = self.shards[index]._get(keys[position])
+        return values
+
+    def put_many_sync(self, items) -> List[tuple]:
+        items = list(items)
+        evicted = []
+        for index, positions in self._group([key for key, _ in items]).items():
+            with self.locks[index]:
+                for position in positions:
+                    evicted.extend(self.shards[index]._put(*items[position]))
+        return evicted
+
+    async def get(self, key):
+        return self.get_sync(key)
+
+    async def pop(self, key):
+        return self.pop_sync(key)
+
+    async def put(self, key, value):
+        await self.shards[0]._demote(self.put_sync(key, value))
+
+    async def get_many(self, keys) -> List[Any]:
+        return self.get_many_sync(keys)
+
+    async def put_many(self, items):
+        await self.shards[0]._demote(self.put_many_sync(items))
+
+class TieredKVCache:
+    """
+    Hierarchy of KVCache tiers ordered hot to cold, e.g. GPU, host memory and a DiskStorage
+    tier, each with its own (byte) capacity. New entries go to the hottest tier, entries
+    evicted from a tier are demoted into the next one instead of being dropped (only the
+    coldest tier really drops), and a hit in a colder tier promotes the entry back to the top.
+    Values are returned as owned copies: promoting one entry can evict and reuse the page
+    behind a view returned for another, even within a single get_many.
+    """
+    def __init__(self, tiers: List[KVCache]):
+        self.tiers = tiers
+        for tier, next_tier in zip(tiers, tiers[1:]):
+            tier.on_evict = next_tier.put
+
+        self.tier_hits = [0] * len(tiers)
+        self.misses = 0
+
+    def __contains__(self, key):
+        return any(key in tier for tier in self.tiers)
+
+    def snapshot_items(self):
+        # Hottest copy first, the writer skips keys it has already seen
+        for tier in self.tiers:
+            yield from tier.snapshot_items()
+
+    def save_snapshot(self, path: str, metadata=None):
+        writer = KVSnapshotWriter(path)
+        for key, value in self.snapshot_items():
+            writer.add(key, value)
+        writer.close(metadata)
+
+    def load_snapshot(self, path: str) -> KVSnapshot:
+        # Served from the hot tier's position, the mapping is backed by the page cache rather than tier memory
+        return self.tiers[0].load_snapshot(path)
+
+    def stats(self) -> Dict[str, Any]:
+        hits = sum(self.tier_hits)
+        lookups = hits + self.misses
+        return {
+            "hits": hits, "misses": self.misses, "tier_hits": list(self.tier_hits),
+            "hit_ratio": hits / lookups if lookups else 0.0,
+            "tiers": [tier.stats() for tier in self.tiers],
+        }
+
+    async def get(self, key):
+        for i, tier in enumerate(self.tiers):
+            if key in tier:
+                self.tier_hits[i] += 1
+                if i > 0:
+                    await self.tiers[0].put(key, await tier.pop(key))
+                value = await self.tiers[0].get(key)
+                return value.clone() if isinstance(value, torch.Tensor) else value
+        self.misses += 1
+        return None
+
+    async def put(self, key, value):
+        for tier in self.tiers[1:]:
+            if key in tier:
+                await tier.pop(key)
+        await self.tiers[0].put(key, value)
+
+    async def get_many(self, keys) -> List[Any]:
+        return [await self.get(key) for key in keys]
+
+    async def put_many(self, items):
+        for key, value in items:
+            await self.put(key, value)
+
+# Polynomial rolling hash over token ids modulo the Mersenne prime 2^61 - 1. Chaining a block
+# onto its parent's hash is h = h * BASE^len(block) + poly(block), so the key of every block
+# boundary of an n-token sequence costs O(n) integer ops, with no strings built or digested.
+ROLLING_HASH_MOD = (1 << 61) - 1
+ROLLING_HASH_BASE = 1_000_003
+_token_ids = {}
+
+def token_id(token) -> int:
+    # Stable across processes, and memoized so each distinct token is only digested once
+    tid = _token_ids.get(token)
+    if tid is None:
+        digest = hashlib.blake2b(str(token).encode(), digest_size=8).digest()
+        tid = _token_ids[token] = int.from_bytes(digest, "big") % (ROLLING_HASH_MOD - 1) + 1
+    return tid
+
+def rolling_hash(parent_hash: int, tokens) -> int:
+    h = parent_hash
+    for i, token in enumerate(tokens, 1):
+        h = h * ROLLING_HASH_BASE + (_token_ids.get(token) or token_id(token))
+        if not i % 16:
+            # Reducing once per few tokens keeps the intermediate small without a modulo per token
+            h %= ROLLING_HASH_MOD
+    return h % ROLLING_HASH_MOD
+
+class RadixNode:
+    def __init__(self, block=(), key=None, parent=None, chain_hash=0):
+        self.block = block      # tokens on the edge from parent to this node
+        self.key = key          # chained hash of every block from the root down to this node
+        self.parent = parent
+        self.children = {}      # block tuple -> RadixNode
+        self.chain_hash = chain_hash
+
+class RadixTree:
+    """
+    Block-granular prefix tree over token sequences, mirroring Mooncake's prefix block reuse.
+
+    A sequence is cut into fixed-size blocks; each node's key chains its parent's key with its
+    own block, so the same block following a different prefix gets a different key. The tree
+    only indexes the chains, the block values themselves live in a KVCache under those keys.
+    """
+    def __init__(self, block_size: int):
+        self.block_size = block_size
+        self.root = RadixNode()
+        self.nodes_by_key = {}
+
+    def _chain_key(self, parent: RadixNode, block) -> tuple:
+        # Returns (chain hash, store key); a key already taken by a different chain is a
+        # collision and gets re-probed, so store keys stay unique among indexed nodes
+        chain_hash = rolling_hash(parent.chain_hash, block)
+        key = f"{chain_hash:016x}"
+        probe = chain_hash
+        while key in self.nodes_by_key:
+            other = self.nodes_by_key[key]
+            if other.parent is parent and other.block == block:
+                break
+            probe = (probe + 1) % ROLLING_HASH_MOD
+            key = f"{chain_hash:016x}-{probe:016x}"
+        return chain_hash, key
+
+    def split_blocks(self, tokens) -> List[tuple]:
+        # Only full blocks are indexed, a trailing partial block is always recomputed
+        num_full = len(tokens) // self.block_size
+        return [tuple(tokens[i * self.block_size:(i + 1) * self.block_size]) for i in range(num_full)]
+
+    def match_prefix(self, tokens) -> List[RadixNode]:
+        # Single traversal from the root, returns the node chain of the longest cached prefix
+        node = self.root
+        chain = []
+        for block in self.split_blocks(tokens):
+            node = node.children.get(block)
+            if node is None:
+                break
+            chain.append(node)
+        return chain
+
+    def insert(self, tokens) -> List[RadixNode]:
+        node = self.root
+        chain = []
+        for block in self.split_blocks(tokens):
+            child = node.children.get(block)
+            if child is None:
+                chain_hash, key = self._chain_key(node, block)
+                child = RadixNode(block, key, node, chain_hash)
+                node.children[block] = child
+                self.nodes_by_key[child.key] = child
+            chain.append(child)
+            node = child
+        return chain
+
+    def remove(self, node: RadixNode):
+        # Drops the node together with its whole subtree, which is unreachable without it
+        if node.parent is not None:
+            node.parent.children.pop(node.block, None)
+            node.parent = None
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            self.nodes_by_key.pop(current.key, None)
+            stack.extend(current.children.values())
+
+# Binary KV transfer framing, all integers in network byte order:
+#   MESSAGE_HEADER (magic, num_entries, index bytes, payload bytes)
+#   index:   per entry ENTRY_HEADER (key_len, dtype code, ndim, payload bytes), key bytes, ndim x u64 shape
+#   payload: the entries' raw tensor memory back to back, each padded to PAYLOAD_ALIGNMENT
+# Payloads are the tensors' own memory, nothing is serialized to strings on either side.
+KV_FRAME_MAGIC = b"MCKV"
+MESSAGE_HEADER = struct.Struct("!4sIIQ")
+ENTRY_HEADER = struct.Struct("!HBBQ")
+PAYLOAD_ALIGNMENT = 8
+KV_FRAME_ACK = b"\x01"
+# Receivers allocate the index and payload buffers from the header, so both are bounded
+KV_FRAME_MAX_INDEX_BYTES = 64 << 20
+KV_FRAME_MAX_PAYLOAD_BYTES = 4 << 30
+# Buffers per sendmsg call, IOV_MAX on Linux
+SENDMSG_MAX_BUFFERS = 1024
+DTYPE_CODES = {
+    torch.float32: 0, torch.float16: 1, torch.bfloat16: 2, torch.float64: 3,
+    torch.int64: 4, torch.int32: 5, torch.int8: 6, torch.uint8: 7,
+}
+CODE_DTYPES = {code: dtype for dtype, code in DTYPE_CODES.items()}
+
+def _padding(nbytes):
+    return -nbytes % PAYLOAD_ALIGNMENT
+
+def encode_kv_frames(kv_data) -> List[Any]:
+    # Returns a scatter-gather list: one header, one index and memoryviews over the tensor storage
+    index = []
+    payloads = []
+    payload_bytes = 0
+    for key, value in kv_data.items():
+        tensor = torch.as_tensor(value).detach().cpu().contiguous()
+        payload = memoryview(tensor.reshape(-1).view(torch.uint8).numpy())
+        key_bytes = key.encode()
+        index.append(ENTRY_HEADER.pack(len(key_bytes), DTYPE_CODES[tensor.dtype], tensor.dim(), payload.nbytes))
+        index.append(key_bytes + struct.pack(f"!{tensor.dim()}Q", *tensor.shape))
+        payloads.append(payload)
+        padding = _padding(payload.nbytes)
+        if padding:
+            payloads.append(bytes(padding))
+        payload_bytes += payload.nbytes + padding
+    index = b"".join(index)
+    return [MESSAGE_HEADER.pack(KV_FRAME_MAGIC, len(kv_data), len(index), payload_bytes), index] + payloads
+
+def decode_kv_index(num_entries, index, payload) -> Dict[str, Any]:
+    # Entries come back as tensor views over the received payload buffer
+    kv_data = {}
+    index_offset = 0
+    payload_offset = 0
+    for _ in range(num_entries):
+        key_len, dtype_code, ndim, nbytes = ENTRY_HEADER.unpack_from(index, index_offset)
+        index_offset += ENTRY_HEADER.size
+        key = bytes(index[index_offset:index_offset + key_len]).decode()
+        index_offset += key_len
+        shape = struct.unpack_from(f"!{ndim}Q", index, index_offset)
+        index_offset += 8 * ndim
+        dtype = CODE_DTYPES[dtype_code]
+        if nbytes:
+            tensor = torch.frombuffer(payload, dtype=dtype, count=nbytes // dtype.itemsize, offset=payload_offset)
+        else:
+            tensor = torch.empty(0, dtype=dtype)
+        kv_data[key] = tensor.reshape(shape)
+        payload_offset += nbytes + _padding(nbytes)
+    return kv_data
+
+class KVFrameReceiver(asyncio.BufferedProtocol):
+    """
+    Receives KV frames with recv_into straight into one preallocated payload buffer per
+    message, so tensor data is never copied through intermediate bytes objects and the
+    number of reads does not grow with the number of entries. Every complete message is
+    handed to `on_message` and acknowledged with one byte once that coroutine succeeds; if it
+    raises, the connection is closed so the sender sees the failure.
+    """
+    def __init__(self, on_message, max_index_bytes=KV_FRAME_MAX_INDEX_BYTES, max_payload_bytes=KV_FRAME_MAX_PAYLOAD_BYTES):
+        self.on_message = on_message
+        self.max_index_bytes = max_index_bytes
+        self.max_payload_bytes = max_payload_bytes
+        self.transport = None
+        # Deliveries still running, referenced so they are not garbage collected midway
+        self.deliveries = set()
+        self._expect(bytearray(MESSAGE_HEADER.size), self._on_message_header)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def _expect(self, buffer, handler):
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+        self._filled = 0
+        self._handler = handler
+
+    def get_buffer(self, sizehint):
+        return self._view[self._filled:]
+
+    def buffer_updated(self, nbytes):
+        self._filled += nbytes
+        # Loop rather than recurse so empty index/payload sections complete immediately
+        while self._filled == len(self._view):
+            self._handler()
+
+    def _on_message_header(self):
+        magic, self._num_entries, index_bytes, self._payload_bytes = MESSAGE_HEADER.unpack(self._buffer)
+        if magic != KV_FRAME_MAGIC:
+            self._reject(f"Invalid KV frame magic {magic!r}")
+        elif index_bytes > self.max_index_bytes or self._payload_bytes > self.max_payload_bytes:
+            self._reject(f"KV frame of {index_bytes} index / {self._payload_bytes} payload bytes exceeds the "
+                         f"{self.max_index_bytes} / {self.max_payload_bytes} byte limit")
+        else:
+            self._expect(bytearray(index_bytes), self._on_index)
+
+    def _reject(self, reason):
+        logger.error(f"{reason}, closing connection")
+        self.transport.close()
+        # Whatever is still in flight lands in a scratch byte
+        self._expect(bytearray(1), lambda: None)
+
+    def _on_index(self):
+        self._index = self._buffer
+        self._expect(bytearray(self._payload_bytes), self._on_payload)
+
+    def _on_payload(self):
+        kv_data = decode_kv_index(self._num_entries, self._index, self._buffer)
+        delivery = asyncio.ensure_future(self._deliver(kv_data))
+        self.deliveries.add(delivery)
+        delivery.add_done_callback(self.deliveries.discard)
+        self._expect(bytearray(MESSAGE_HEADER.size), self._on_message_header)
+
+    async def _deliver(self, kv_data):
+        # Acknowledged only once stored. On failure the connection is closed instead, so the
+        # sender's transfer raises rather than taking the message as delivered
+        try:
+            await self.on_message(kv_data)
+        except Exception:
+            logger.exception(f"Storing a KV message of {len(kv_data)} entries failed, closing connection")
+            self.transport.close()
+            return
+        if not self.transport.is_closing():
+            self.transport.write(KV_FRAME_ACK)
+
+class KVTransferServer:
+    # Runs next to a decoding node and stores every received message into its KVCache
+    def __init__(self, destination):
+        self.destination = destination
+        self.server = None
+
+    async def _store(self, kv_data):
+        await self.destination.put_many(kv_data.items())
+
+    async def start(self, host='127.0.0.1', port=0, unix_path=None):
+        loop = asyncio.get_running_loop()
+        if unix_path is not None:
+            self.server = await loop.create_unix_server(lambda: KVFrameReceiver(self._store), unix_path)
+        else:
+            self.server = await loop.create_server(lambda: KVFrameReceiver(self._store), host, port)
+        return self.server.sockets[0].getsockname()
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+class KVTransferClient:
+    """
+    Sends KV frames over its own non-blocking socket with sendmsg, so the header, index and
+    tensor memoryviews go out as one scatter-gather list without being joined into a single
+    bytes object first (asyncio's writelines only does that from Python 3.12 on).
+    """
+    def __init__(self, host='127.0.0.1', port=None, unix_path=None):
+        self.host = host
+        self.port = port
+        self.unix_path = unix_path
+        self.sock = None
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        if self.unix_path is not None:
+            sock, address = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM), self.unix_path
+        else:
+            family, sock_type, proto, _, address = (await loop.getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM))[0]
+            sock = socket.socket(family, sock_type, proto)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, address)
+        except BaseException:
+            sock.close()
+            raise
+        self.sock = sock
+
+    async def _send_buffers(self, buffers):
+        loop = asyncio.get_running_loop()
+        if not hasattr(self.sock, "sendmsg"):
+            await loop.sock_sendall(self.sock, b"".join(buffers))
+            return
+        views = [view for view in (memoryview(buffer).cast("B") for buffer in buffers) if view.nbytes]
+        first = 0
+        while first < len(views):
+            try:
+                sent = self.sock.sendmsg(views[first:first + SENDMSG_MAX_BUFFERS])
+            except (BlockingIOError, InterruptedError):
+                writable = loop.create_future()
+                loop.add_writer(self.sock.fileno(), lambda: writable.done() or writable.set_result(None))
+                try:
+                    await writable
+                finally:
+                    loop.remove_writer(self.sock.fileno())
+                continue
+            # A partial send resumes inside the buffer it stopped in
+            while sent and sent >= views[first].nbytes:
+                sent -= views[first].nbytes
+                first += 1
+            if sent:
+                views[first] = views[first][sent:]
+
+    async def send(self, kv_data):
+        # One message in flight per connection, returns once the receiver has stored it
+        async with self.lock:
+            if self.sock is None:
+                await self.connect()
+            try:
+                await self._send_buffers(encode_kv_frames(kv_data))
+                ack = b""
+                while len(ack) < len(KV_FRAME_ACK):
+                    chunk = await asyncio.get_running_loop().sock_recv(self.sock, len(KV_FRAME_ACK) - len(ack))
+                    if not chunk:
+                        raise ConnectionError("KV receiver closed the connection before acknowledging")
+                    ack += chunk
+            except BaseException:
+                # A partly sent message leaves the stream unusable, the next send reconnects
+                self.sock.close()
+                self.sock = None
+                raise
+
+    async def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
 
 class Messenger:
+    def __init__(self):
+        # Destination address -> KVTransferClient, reused across transfers
+        self.clients = {}
+
     async def transfer_kv_cache(self, source, destination, kv_data):
-        for key, value in kv_data.items():
-            await destination.put(key, value)
+        await destination.put_many(kv_data.items())
 
     async def transfer_kv_cache_rdma(self, source, destination, kv_data):
         # Simulate RDMA transfer
@@ -63,150 +1421,514 @@ class Messenger:
             # nvidia_p2p_get_pages(...)
             # Perform RDMA transfer
             # nvidia_p2p_put_pages(...)
-    # async def transfer_kv_cache_rdma(self, source, destination, kv_data):
-    #     # Simulate RDMA transfer using asyncio streams
-    #     reader, writer = await asyncio.open_connection('127.0.0.1', 8888)
-    #     for key, value in kv_data.items():
-    #         writer.write(f"{key}:{value}\n".encode())
-    #         await writer.drain()
-    #     writer.write_eof()
-    #     await writer.wait_closed()            
+
+    @traced("kv_transfer_socket")
+    async def transfer_kv_cache_socket(self, address, kv_data):
+        # `address` is a (host, port) tuple for TCP or a path string for a Unix socket
+        client = self.clients.get(address)
+        if client is None:
+            if isinstance(address, str):
+                client = KVTransferClient(unix_path=address)
+            else:
+                client = KVTransferClient(host=address[0], port=address[1])
+            self.clients[address] = client
+        await client.send(kv_data)
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.close()
+        self.clients.clear()
 
 class PrefillNode:
-    def __init__(self, gpu_memory, cpu_memory, window_size=3):
+    def __init__(self, gpu_memory, cpu_memory, window_size=3, disk_memory=None):
         self.gpu_memory = gpu_memory
         self.cpu_memory = cpu_memory
+        self.disk_memory = disk_memory
         self.window_size = window_size
+        # Prefix blocks live in the hot tier and spill to host memory, then disk, under pressure
+        self.kv_store = TieredKVCache([tier for tier in (gpu_memory, cpu_memory, disk_memory) if tier is not None])
+        # Each window_size tokens form one cache block
+        self.prefix_tree = RadixTree(block_size=window_size)
+        for tier in self.kv_store.tiers:
+            for cache in getattr(tier, 'shards', [tier]):
+                if isinstance(cache.policy, PrefixAwarePolicy):
+                    cache.policy.bind_tree(self.prefix_tree)
+        # Requests dispatched to this node and not completed yet, maintained by the Conductor
+        self.current_load = 0
+        # Prompt tokens seen and how many of them were served from cached prefix blocks
+        self.prompt_tokens = 0
+        self.reused_tokens = 0
+        # Uncached tokens dispatched here and not prefilled yet, maintained by the Conductor
+        self.queued_tokens = 0
+        # Moving average of measured prefill seconds per forwarded (uncached) token, None until the first batch
+        self.seconds_per_token = None
+
+    def cache_stats(self) -> Dict[str, Any]:
+        return self.kv_store.stats()
+
+    def cached_prefix_length(self, input_tokens) -> int:
+        # Read-only probe for the scheduler, unlike match_cached_prefix it neither prunes nor touches LRU order
+        num_blocks = 0
+        for node in self.prefix_tree.match_prefix(input_tokens):
+            if node.key not in self.kv_store:
+                break
+            num_blocks += 1
+        return num_blocks * self.window_size
+
+    async def match_cached_prefix(self, input_tokens) -> List[RadixNode]:
+        chain = []
+        for node in self.prefix_tree.match_prefix(input_tokens):
+            if node.key not in self.kv_store:
+                # The block was evicted from the store, so nothing below it is reusable either
+                self.prefix_tree.remove(node)
+                break
+            chain.append(node)
+        return chain
+
+    def save_snapshot(self, path: str):
+        # The KV entries plus the radix tree chains leading to them, parents before children,
+        # skipping subtrees below a block that is no longer stored since they can never match
+        nodes = []
+        stack = [child for child in self.prefix_tree.root.children.values()]
+        while stack:
+            node = stack.pop()
+            if node.key not in self.kv_store:
+                continue
+            nodes.append([node.key, node.parent.key, list(node.block), node.chain_hash])
+            stack.extend(node.children.values())
+        self.kv_store.save_snapshot(path, metadata={"window_size": self.window_size, "prefix_tree": nodes})
+
+    def load_snapshot(self, path: str):
+        # Warm restart: reattach the stored blocks lazily and rebuild the chains that index them
+        snapshot = self.kv_store.load_snapshot(path)
+        if snapshot.metadata.get("window_size") != self.window_size:
+            logger.warning(f"Snapshot {path} was taken with a different window size, ignoring its prefix tree")
+            return
+        for key, parent_key, block, chain_hash in snapshot.metadata.get("prefix_tree", []):
+            parent = self.prefix_tree.root if parent_key is None else self.prefix_tree.nodes_by_key.get(parent_key)
+            if parent is None or key in self.prefix_tree.nodes_by_key:
+                continue
+            block = tuple(block)
+            node = RadixNode(block, key, parent, chain_hash)
+            parent.children[block] = node
+            self.prefix_tree.nodes_by_key[key] = node
+        logger.info(f"Restored {len(self.prefix_tree.nodes_by_key)} prefix blocks from snapshot {path}")
 
-    @timing_decorator
     async def prefill(self, input_tokens, reusable_block_ids):
-        new_kv_data = {}
-        uncached_windows = []
-
-        # Check for cached results using sliding window
-        for i in range(len(input_tokens) - self.window_size + 1):
-            window = tuple(input_tokens[i:i+self.window_size])
-            window_hash = self.cpu_memory._hash_key(str(window))
-            cached_result = await self.cpu_memory.get(window_hash)
-            if cached_result is not None:
-                new_kv_data[window_hash] = cached_result
-            else:
-                uncached_windows.append(window)
-
-        # Process only uncached windows
-        if uncached_windows:
-            logger.info(f"Processing {len(uncached_windows)} uncached windows")
-            """
-            Sample uncached_windows:
-            uncached_windows = [['apple', 'banana', 'cherry'], ['banana', 'cherry', 'date'], ['cherry', 'date', 'apple']]
-
-            Sample uncached_tokens:
-            uncached_tokens = ['apple', 'banana', 'cherry', 'date']
-
-            Sample mapping:
-            token_to_hidden_state =
-            {
-                'apple': [0.1, 0.2, 0.3, ..., 0.5],  # dimensional hidden state for 'apple'
-                'banana': [0.6, 0.7, 0.8, ..., 0.9],  # dimensional hidden state for 'banana'
-                'cherry': [0.1, 0.2, 0.3, ..., 0.4],  # dimensional hidden state for 'cherry'
-                'date': [0.5, 0.6, 0.7, ..., 0.8]  # dimensional hidden state for 'date'
-            }
-            """
-            uncached_tokens = list(set(token for window in uncached_windows for token in window))
-            inputs = tokenizer(uncached_tokens, return_tensors="pt", padding=True, truncation=True)
-            with torch.no_grad():
-                outputs = model(**inputs)
-
-            if outputs.hidden_states is None:
-                logger.error("Model did not return hidden_states.")
-                return None
-
-            hidden_states = outputs.hidden_states[-1]
-            num_tokens = hidden_states.size(1)
-            # Store the hidden states for the entire window, not just individual tokens since number of auto-regressive hidden states that may not directly correspond to input tokens, which means the prefill might return fewer hidden states than the number of input   tokens due to padding, truncation, or other preprocessing steps.
-            token_to_hidden_state = {token: hidden_states[0, i].tolist() for i, token in enumerate(uncached_tokens) if i < num_tokens}
-
-            # Process and cache new results for each window
-            for window in uncached_windows:
-                window_hidden_states = [token_to_hidden_state.get(token, []) for token in window]
-                window_hash = self.cpu_memory._hash_key(str(window))
-                new_kv_data[window_hash] = window_hidden_states
-                await self.cpu_memory.put(window_hash, window_hidden_states)
-
-        logger.info(f"Processed {len(uncached_windows)} uncached windows")
-        return new_kv_data
+        return (await self.prefill_batch([input_tokens]))[0]
+
+    async def prefill_batch(self, batch_tokens: List[List[str]], request_ids=None) -> List[Dict[str, Any]]:
+        """
+        Cached blocks hold the keys/values of their word pieces for every layer. Per request
+        the cached prefix blocks are concatenated and only the uncached suffix goes through
+        the model, batched across requests on top of each prefix. The prompt's full keys and
+        values (prefix plus suffix) are returned under PROMPT_KV_KEY for the decoding node,
+        and every new full block is cached under its chain key.
+        """
+        start_time = time.perf_counter()
+        batch_kv_data = []
+        batch_requests = []
+        request_ids = request_ids if request_ids is not None else [current_request_id.get()] * len(batch_tokens)
+
+        # Find the longest cached prefix of each request in one traversal, only the suffix after it is prefilled
+        for input_tokens, request_id in zip(batch_tokens, request_ids):
+            with tracer.span("cache_lookup", lambda: {"tokens": len(input_tokens)}, request_id=request_id) as span:
+                token_ids, word_starts = prompt_encoding(input_tokens)
+                num_full = len(input_tokens) // self.window_size
+                # Block b covers token_ids[bounds[b]:bounds[b + 1]], [CLS] belongs to the first block
+                bounds = [0] + [word_starts[b * self.window_size] for b in range(1, num_full + 1)]
+                cached_chain = await self.match_cached_prefix(input_tokens)
+                cached_values = await self.kv_store.get_many([node.key for node in cached_chain])
+                # A block dropped by a promotion in between ends the usable prefix
+                cached_values = list(itertools.takewhile(lambda value: value is not None, cached_values))
+                cached_chain = cached_chain[:len(cached_values)]
+                # Back on the model's device and dtype, whichever tier the blocks came from
+                prefix = torch.cat(cached_values, dim=2).to('cpu', model_handle.dtype or torch.float32) if cached_values else None
+                prefix_len = bounds[len(cached_chain)] if cached_chain else 0
+                if prefix is not None and prefix.size(2) != prefix_len:
+                    logger.warning(f"Cached prefix holds {prefix.size(2)} positions instead of {prefix_len}, recomputing it")
+                    cached_chain, prefix, prefix_len = [], None, 0
+                num_cached_tokens = len(cached_chain) * self.window_size
+                span.set(cached_tokens=num_cached_tokens)
+            self.prompt_tokens += len(input_tokens)
+            self.reused_tokens += num_cached_tokens
+            # Block index of every uncached token id, the trailing partial block is one more
+            block_ids = [bisect.bisect_right(bounds, position) - 1 for position in range(prefix_len, len(token_ids))]
+            batch_requests.append((input_tokens, cached_chain, prefix, token_ids[prefix_len:], block_ids, bounds))
+            logger.info(f"Reusing {num_cached_tokens} cached tokens, prefilling {len(input_tokens) - num_cached_tokens}")
+
+        # One forward over the uncached suffixes only, each on top of its own cached prefix
+        to_encode = [i for i, request in enumerate(batch_requests) if request[3]]
+        suffix_kv = {}
+        if to_encode:
+            encoded = await asyncio.to_thread(encode_suffixes, [batch_requests[i][2:5] for i in to_encode])
+            suffix_kv = dict(zip(to_encode, encoded))
+
+        for i, (input_tokens, cached_chain, prefix, suffix_ids, block_ids, bounds) in enumerate(batch_requests):
+            parts = [part for part in (prefix, suffix_kv.get(i)) if part is not None]
+            prompt_kv = torch.cat(parts, dim=2) if len(parts) > 1 else parts[0]
+            batch_kv_data.append({PROMPT_KV_KEY: prompt_kv})
+            full_chain = self.prefix_tree.insert(input_tokens)
+            new_blocks = [(node.key, prompt_kv[:, :, bounds[b]:bounds[b + 1]].clone())
+                          for b, node in enumerate(full_chain) if b >= len(cached_chain)]
+            if new_blocks:
+                await self.kv_store.put_many(new_blocks)
+
+        # Only the uncached suffixes went through the forward, so this is the cost per forwarded token
+        num_uncached = sum(len(input_tokens) - len(cached_chain) * self.window_size for input_tokens, cached_chain, *_ in batch_requests)
+        if num_uncached:
+            self.seconds_per_token = ewma(self.seconds_per_token, (time.perf_counter() - start_time) / num_uncached)
+        logger.info(f"Processed {num_uncached} uncached tokens for {len(batch_tokens)} requests")
+        return batch_kv_data
+
+class PrefillBatcher:
+    """
+    Continuous-batching queue in front of one PrefillNode. Requests arriving within
+    `batch_window` seconds of each other are coalesced into a single prefill_batch call
+    (at most `max_batch_size` requests), and each request's future is resolved with its
+    own slice of the results.
+    """
+    def __init__(self, prefill_node: PrefillNode, batch_window: float = 0.005, max_batch_size: int = 16):
+        self.prefill_node = prefill_node
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.pending = []
+        self._task = None
+
+    def queue_depth(self) -> int:
+        return len(self.pending)
+
+    async def submit(self, input_tokens, reusable_block_ids):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((input_tokens, current_request_id.get(), future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return await future
+
+    async def _run(self):
+        # The task inherited its first submitter's context, batches belong to no single request
+        current_request_id.set(None)
+        while self.pending:
+            # Give concurrent requests the batch window to join, unless the batch is already full
+            if len(self.pending) < self.max_batch_size:
+                await asyncio.sleep(self.batch_window)
+            batch = self.pending[:self.max_batch_size]
+            self.pending = self.pending[self.max_batch_size:]
+            request_ids = [request_id for _, request_id, _ in batch]
+            try:
+                with tracer.span("prefill_batch", lambda: {"requests": len(batch)}, request_ids=request_ids):
+                    results = await self.prefill_node.prefill_batch([input_tokens for input_tokens, _, _ in batch], request_ids)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+class PromptInbox:
+    # Prompt keys/values transferred from prefill, each held until the decode of its request takes it.
+    # Unbounded on purpose: unlike a cache, evicting an entry here would lose a request's prompt
+    def __init__(self):
+        self.entries = {}
+
+    async def put_many(self, items):
+        self.entries.update(items)
+
+    def take(self, prompt_key):
+        past_key_values = self.entries.pop(prompt_key, None)
+        if past_key_values is None:
+            raise RuntimeError(f"No prompt keys/values received for {prompt_key}")
+        return past_key_values
+
+    def discard(self, prompt_key):
+        # For a request that failed before its decode took the entry
+        self.entries.pop(prompt_key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"entries": len(self.entries)}
 
 class DecodingNode:
-    def __init__(self, cpu_memory):
-        self.cpu_memory = cpu_memory
+    def __init__(self, cpu_memory=None):
+        # Receives the prompt keys/values the Messenger transfers from the prefill node
+        self.cpu_memory = cpu_memory if cpu_memory is not None else PromptInbox()
         self.current_load = 0
+        # Moving average of measured decode step seconds per concurrent request, None until the first step
+        self.step_seconds = None
 
     async def receive_kv_cache(self, kv_data):
-        for key, value in kv_data.items():
-            await self.cpu_memory.put(key, value)
+        await self.cpu_memory.put_many(kv_data.items())
 
-    @timing_decorator
-    async def decode(self, tokens: List[str]) -> List[str]:
-        decoded_tokens = []
-        for token in tokens:
-            token_hash = self.cpu_memory._hash_key(token)
-            cached_vector = await self.cpu_memory.get(token_hash)
-            if cached_vector is not None:
-                logits = torch.tensor(cached_vector).unsqueeze(0)
-            else:
-                inputs = tokenizer(token, return_tensors="pt")
-                with torch.no_grad():
-                    outputs = model(**inputs)
-                logits = outputs.logits
+    async def generate(self, tokens: List[str], past_key_values=None, max_new_tokens: int = 16):
+        """
+        Streams generated tokens one at a time. Each step feeds the previously generated token
+        plus a trailing [MASK] slot on top of the cached keys/values, reads the prediction at the
+        [MASK] and keeps only the real token's keys/values, so a step costs O(sequence length).
+        Without `past_key_values` from prefill the prompt is encoded here first, as one block.
+        """
+        if past_key_values is None:
+            token_ids, _ = prompt_encoding(tokens)
+            past_key_values = (await asyncio.to_thread(encode_suffixes, [(None, token_ids, [0] * len(token_ids))]))[0]
+        past_key_values = past_key_values.unsqueeze(2)
+        max_new_tokens = min(max_new_tokens, model.config.max_position_embeddings - past_key_values.size(-2) - 1)
 
-            logger.info(f"Decoding token: {token}")
+        step_ids = []
+        for step in range(max_new_tokens):
+            input_ids = torch.tensor([step_ids + [tokenizer.mask_token_id]])
+            step_start = time.perf_counter()
+            with tracer.span("decode_step", lambda: {"context_tokens": past_key_values.size(-2)}, step=step):
+                logits, _, step_past = await asyncio.to_thread(forward_with_past, input_ids, past_key_values)
+            self.step_seconds = ewma(self.step_seconds, (time.perf_counter() - step_start) / max(self.current_load, 1))
+            past_key_values = step_past[..., :-1, :]
             predicted_token_id = torch.argmax(logits[0, -1]).item()
-            decoded_token = tokenizer.decode([predicted_token_id])
+            if predicted_token_id == tokenizer.sep_token_id:
+                break
+            step_ids = [predicted_token_id]
+            yield tokenizer.decode([predicted_token_id])
+
+    @traced("decode")
+    async def decode(self, tokens: List[str], prompt_key=None, max_new_tokens: int = 16, on_token=None) -> List[str]:
+        # Starts from the prompt keys/values transferred under `prompt_key`, without one the prompt is encoded here.
+        # `on_token` is called with every token as soon as it is generated, e.g. to stream it or time it
+        past_key_values = self.cpu_memory.take(prompt_key) if prompt_key is not None else None
+        decoded_tokens = []
+        async for decoded_token in self.generate(tokens, past_key_values, max_new_tokens):
+            logger.info(f"Decoded token: {decoded_token}")
             decoded_tokens.append(decoded_token)
+            if on_token is not None:
+                on_token(decoded_token)
         return decoded_tokens
 
+class SchedulingPolicy:
+    def select_prefill_node(self, prefill_nodes: List[PrefillNode], input_tokens) -> PrefillNode:
+        raise NotImplementedError
+
+    def select_decoding_node(self, decoding_nodes: List[DecodingNode], input_tokens) -> DecodingNode:
+        return min(decoding_nodes, key=lambda node: node.current_load)
+
+class LeastLoadedPolicy(SchedulingPolicy):
+    def select_prefill_node(self, prefill_nodes: List[PrefillNode], input_tokens) -> PrefillNode:
+        return min(prefill_nodes, key=lambda node: node.current_load)
+
+class CacheAwarePolicy(SchedulingPolicy):
+    """
+    KVCache-centric selection in the spirit of Mooncake's scheduler: each prefill node is
+    scored by the tokens it would still have to prefill (prompt minus its longest cached
+    prefix) plus `load_penalty` tokens for every request already in flight on it, and the
+    cheapest node wins. A large penalty degrades to least-loaded, zero to pure cache affinity.
+    """
+    def __init__(self, load_penalty: int = 32):
+        self.load_penalty = load_penalty
+
+    def estimate_cost(self, node: PrefillNode, input_tokens) -> int:
+        uncached_tokens = len(input_tokens) - node.cached_prefix_length(input_tokens)
+        return uncached_tokens + self.load_penalty * node.current_load
+
+    def select_prefill_node(self, prefill_nodes: List[PrefillNode], input_tokens) -> PrefillNode:
+        return min(prefill_nodes, key=lambda node: self.estimate_cost(node, input_tokens))
+
+class RequestRejected(Exception):
+    pass
+
+class AdmissionController:
+    """
+    SLO-aware admission in the spirit of Mooncake's overload-oriented scheduling. Before a
+    request is dispatched its TTFT is estimated as the uncached tokens queued on the chosen
+    prefill node plus its own uncached suffix, times that node's measured seconds per token,
+    and its TBT as the decoding node's measured step cost times its concurrency after joining.
+    A request that would miss `ttft_slo` or `tbt_slo` is deferred and re-evaluated every
+    `defer_interval` seconds for up to `max_defer` seconds, then rejected with RequestRejected,
+    so excess load is shed early instead of slowing every request down.
+    """
+    def __init__(self, ttft_slo: float = 2.0, tbt_slo: float = 0.2, max_defer: float = 0.5, defer_interval: float = 0.02,
+                 default_seconds_per_token: float = 2e-3, default_step_seconds: float = 2e-2):
+        self.ttft_slo = ttft_slo
+        self.tbt_slo = tbt_slo
+        self.max_defer = max_defer
+        self.defer_interval = defer_interval
+        # Used until the nodes have measured their own costs
+        self.default_seconds_per_token = default_seconds_per_token
+        self.default_step_seconds = default_step_seconds
+        self.admitted = 0
+        self.deferred = 0
+        self.rejected = 0
+
+    def estimate_ttft(self, node: PrefillNode, uncached_tokens: int) -> float:
+        seconds_per_token = node.seconds_per_token if node.seconds_per_token is not None else self.default_seconds_per_token
+        return (node.queued_tokens + uncached_tokens) * seconds_per_token
+
+    def estimate_tbt(self, node: DecodingNode) -> float:
+        step_seconds = node.step_seconds if node.step_seconds is not None else self.default_step_seconds
+        return step_seconds * (node.current_load + 1)
+
+    async def admit(self, conductor, input_tokens) -> tuple:
+        # Returns the (prefill node, decoding node) pair the estimates were made for, or raises RequestRejected
+        deadline = time.perf_counter() + self.max_defer
+        deferred = False
+        while True:
+            prefill_node = conductor.select_prefill_node(input_tokens)
+            decoding_node = conductor.select_decoding_node(input_tokens)
+            uncached_tokens = len(input_tokens) - prefill_node.cached_prefix_length(input_tokens)
+            ttft = self.estimate_ttft(prefill_node, uncached_tokens)
+            tbt = self.estimate_tbt(decoding_node)
+            if ttft <= self.ttft_slo and tbt <= self.tbt_slo:
+                self.admitted += 1
+                return prefill_node, decoding_node
+            if time.perf_counter() + self.defer_interval > deadline:
+                self.rejected += 1
+                raise RequestRejected(f"Estimated TTFT {ttft:.3f}s / TBT {tbt:.3f}s exceeds SLO {self.ttft_slo}s / {self.tbt_slo}s")
+            if not deferred:
+                deferred = True
+                self.deferred += 1
+            await asyncio.sleep(self.defer_interval)
+
 class Conductor:
-    def __init__(self, prefill_nodes: List[PrefillNode], decoding_nodes: List[DecodingNode], messenger: Messenger):
+    def __init__(self, prefill_nodes: List[PrefillNode], decoding_nodes: List[DecodingNode], messenger: Messenger,
+                 batch_window: float = 0.005, max_batch_size: int = 16, policy: SchedulingPolicy = None,
+                 admission: AdmissionController = None):
         self.prefill_nodes = prefill_nodes
         self.decoding_nodes = decoding_nodes
         self.messenger = messenger
+        self.policy = policy if policy is not None else CacheAwarePolicy()
+        # Without an admission controller every request is accepted
+        self.admission = admission
+        self.prefill_batchers = {node: PrefillBatcher(node, batch_window, max_batch_size) for node in prefill_nodes}
+        self.request_ids = itertools.count()
 
-    async def handle_request(self, input_tokens: List[str], reusable_block_ids: List[int]) -> List[str]:
+    async def handle_request(self, input_tokens: List[str], reusable_block_ids: List[int], max_new_tokens: int = 16, on_token=None,
+                             request_id=None) -> List[str]:
+        context_token = current_request_id.set(request_id if request_id is not None else next(self.request_ids))
         try:
-            selected_prefill_node = self.select_prefill_node()
-            new_kv_data = await selected_prefill_node.prefill(input_tokens, reusable_block_ids)
-            selected_decoding_node = self.select_decoding_node()
-            await self.messenger.transfer_kv_cache(selected_prefill_node.cpu_memory, selected_decoding_node.cpu_memory, new_kv_data)
-            # await self.messenger.transfer_kv_cache_rdma(selected_prefill_node.cpu_memory, selected_decoding_node.cpu_memory, new_kv_data)
-            decoded_tokens = await selected_decoding_node.decode(input_tokens)
+            with tracer.span("request", lambda: {"tokens": len(input_tokens)}):
+                return await self._handle_request(input_tokens, reusable_block_ids, max_new_tokens, on_token)
+        finally:
+            current_request_id.reset(context_token)
+
+    async def _handle_request(self, input_tokens, reusable_block_ids, max_new_tokens, on_token):
+        try:
+            if self.admission is not None:
+                selected_prefill_node, selected_decoding_node = await self.admission.admit(self, input_tokens)
+            else:
+                selected_prefill_node = self.select_prefill_node(input_tokens)
+                selected_decoding_node = self.select_decoding_node(input_tokens)
+            uncached_tokens = len(input_tokens) - selected_prefill_node.cached_prefix_length(input_tokens)
+            selected_prefill_node.current_load += 1
+            selected_prefill_node.queued_tokens += uncached_tokens
+            try:
+                new_kv_data = await self.prefill_batchers[selected_prefill_node].submit(input_tokens, reusable_block_ids)
+            finally:
+                selected_prefill_node.current_load -= 1
+                selected_prefill_node.queued_tokens -= uncached_tokens
+
+            prompt_key = prompt_kv_key(current_request_id.get())
+            kv_data = {prompt_key: new_kv_data[PROMPT_KV_KEY]}
+            selected_decoding_node.current_load += 1
+            try:
+                with tracer.span("kv_transfer", lambda: {"blocks": len(kv_data)}):
+                    await self.messenger.transfer_kv_cache(selected_prefill_node.cpu_memory, selected_decoding_node.cpu_memory, kv_data)
+                # await self.messenger.transfer_kv_cache_rdma(selected_prefill_node.cpu_memory, selected_decoding_node.cpu_memory, kv_data)
+                decoded_tokens = await selected_decoding_node.decode(input_tokens, prompt_key, max_new_tokens, on_token)
+            except BaseException:
+                # Nothing takes the transferred entry once the request has failed
+                selected_decoding_node.cpu_memory.discard(prompt_key)
+                raise
+            finally:
+                selected_decoding_node.current_load -= 1
             logger.info(f"Decoded tokens: {decoded_tokens}")
             return decoded_tokens
         except Exception as e:
             logger.info(f"Error handling request: {str(e)}")
             raise
 
-    def select_prefill_node(self) -> PrefillNode:
-        return self.prefill_nodes[0]
+    def select_prefill_node(self, input_tokens) -> PrefillNode:
+        return self.policy.select_prefill_node(self.prefill_nodes, input_tokens)
 
-    def select_decoding_node(self) -> DecodingNode:
-        return min(self.decoding_nodes, key=lambda node: node.current_load)
+    def select_decoding_node(self, input_tokens) -> DecodingNode:
+        return self.policy.select_decoding_node(self.decoding_nodes, input_tokens)
 
-async def main():
-    cpu_memory = KVCache(capacity=1000)
-    gpu_memory = KVCache(capacity=1000)
+async def main(snapshot_path=None):
+    dim = model_handle.config.dim
+    block_rows = kv_block_rows(window_size=3)
+    block_bytes = block_rows * dim * 4
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    gpu_memory = KVCache(capacity=1000, capacity_bytes=256 * block_bytes,
+                         storage=BlockPoolStorage(num_pages=256, page_tokens=block_rows, hidden_size=dim, device=device))
+    cpu_memory = KVCache(capacity=1000, capacity_bytes=1000 * block_bytes,
+                         storage=BlockPoolStorage(num_pages=1000, page_tokens=block_rows, hidden_size=dim))
+    # A file of this process's own, removed on exit
+    fd, disk_path = tempfile.mkstemp(prefix="mooncake_kv_cache_", suffix=".bin")
+    os.close(fd)
+    try:
+        disk_memory = KVCache(capacity=10000, storage=DiskStorage(disk_path, num_slots=10000, slot_bytes=block_bytes))
+        messenger = Messenger()
+        prefill_node = PrefillNode(gpu_memory, cpu_memory, window_size=3, disk_memory=disk_memory)
+        if snapshot_path is not None and os.path.exists(snapshot_path):
+            prefill_node.load_snapshot(snapshot_path)
+        decoding_node = DecodingNode()
+        conductor = Conductor([prefill_node], [decoding_node], messenger)
+
+        input_tokens = ["Hello", "world", "how", "are", "you"]
+        reusable_block_ids = [1, 2, 3]
+
+        try:
+            result = await conductor.handle_request(input_tokens, reusable_block_ids)
+            logger.info(f"Generated Tokens: {result}")
+        except Exception as e:
+            logger.info(f"Error in main execution: {str(e)}")
+        if snapshot_path is not None:
+            prefill_node.save_snapshot(snapshot_path)
+    finally:
+        os.remove(disk_path)
+
+async def benchmark_kv_transfer(num_blocks=256, block_tokens=3, hidden_size=768, iterations=20, unix_path=None):
+    # Loopback throughput of the socket transport against the in-process copy
+    kv_data = {f"block-{i}": torch.randn(block_tokens, hidden_size) for i in range(num_blocks)}
+    payload_bytes = sum(value.numel() * value.element_size() for value in kv_data.values())
     messenger = Messenger()
-    prefill_node = PrefillNode(gpu_memory, cpu_memory, window_size=3)
-    decoding_node = DecodingNode(cpu_memory)
-    conductor = Conductor([prefill_node], [decoding_node], messenger)
 
-    input_tokens = ["Hello", "world", "how", "are", "you"]
-    reusable_block_ids = [1, 2, 3]
+    destination = KVCache(capacity=num_blocks)
+    start_time = time.perf_counter()
+    for _ in range(iterations):
+        await messenger.transfer_kv_cache(None, destination, kv_data)
+    in_process_time = (time.perf_counter() - start_time) / iterations
 
+    destination = KVCache(capacity=num_blocks)
+    server = KVTransferServer(destination)
+    address = await server.start(unix_path=unix_path)
     try:
-        result = await conductor.handle_request(input_tokens, reusable_block_ids)
-        logger.info(f"Generated Tokens: {result}")
-    except Exception as e:
-        logger.info(f"Error in main execution: {str(e)}")
+        await messenger.transfer_kv_cache_socket(address, kv_data)  # warm up the connection
+        start_time = time.perf_counter()
+        for _ in range(iterations):
+            await messenger.transfer_kv_cache_socket(address, kv_data)
+        socket_time = (time.perf_counter() - start_time) / iterations
+    finally:
+        await messenger.close()
+        await server.stop()
+
+    assert torch.equal(await destination.get("block-0"), kv_data["block-0"]), "KV transfer corrupted the payload"
+    transport = "unix" if unix_path is not None else "tcp"
+    logger.info(f"{num_blocks} blocks, {payload_bytes / 2**20:.2f} MiB per transfer")
+    logger.info(f"in-process: {in_process_time * 1e3:.3f} ms, {payload_bytes / in_process_time / 2**30:.2f} GiB/s")
+    logger.info(f"{transport} socket: {socket_time * 1e3:.3f} ms, {payload_bytes / socket_time / 2**30:.2f} GiB/s")
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Mooncake-style disaggregated prefill/decode demo")
+    parser.add_argument("--bench-transfer", action="store_true", help="benchmark the loopback KV socket transport")
+    parser.add_argument("--unix-socket", default=None, help="Unix socket path for --bench-transfer instead of TCP")
+    parser.add_argument("--trace", default=None, help="record spans to this file, JSON lines if it ends in .jsonl else Chrome trace format")
+    parser.add_argument("--kv-snapshot", default=None, help="warm-start the prefill node's KV cache from this file if it exists and save it on exit")
+    parser.add_argument("--dtype", choices=["float32", "bfloat16"], default=None, help="load the model in this dtype")
+    parser.add_argument("--quantize", action="store_true", help="int8 dynamic quantization of the model's Linear layers")
+    parser.add_argument("--inference-mode", action="store_true", help="run forwards under torch.inference_mode")
+    args = parser.parse_args()
+    model_handle.configure(dtype=args.dtype, quantize=args.quantize, inference_mode=args.inference_mode)
+    if args.trace:
+        tracer.set_sink(JSONLSink(args.trace) if args.trace.endswith(".jsonl") else ChromeTraceSink(args.trace))
+    try:
+        if args.bench_transfer:
+            asyncio.run(benchmark_kv_transfer(unix_path=args.unix_socket))
+        else:
+            asyncio.run(main(args.kv_snapshot))
+    finally:
+        tracer.set_sink(None)
\ No newline at end of file
@@ -0,0 +1,244 @@
+"""
+Offline load generator and latency benchmark for the mooncake.py pipeline.
+
+Replays a synthetic trace through a Conductor with a configurable share of requests reusing
+a common prefix, Poisson or bursty (Gamma) arrivals and a prompt length distribution, then
+reports TTFT, TBT, end-to-end latency (mean/p50/p95/p99), throughput and the prefix cache hit
+ratio as JSON. Meant for comparing scheduling and cache policies on a CPU box:
+
+    python mooncake_bench.py --tiny-model --requests 200 --rate 20 --prefix-share 0.8 --output results.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from typing import List, Dict, Any
+
+import mooncake
+from mooncake import (
+    AdmissionController, BlockPoolStorage, CacheAwarePolicy, ChromeTraceSink, Conductor, DecodingNode, JSONLSink, KVCache,
+    LeastLoadedPolicy, Messenger, PrefillNode, RequestRejected, kv_block_rows,
+)
+
+SCHEDULING_POLICIES = {"cache_aware": CacheAwarePolicy, "least_loaded": LeastLoadedPolicy}
+
+def percentile(values, q):
+    # Linear interpolation between closest ranks, q in [0, 100]
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+def summarize(values) -> Dict[str, Any]:
+    return {
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+    }
+
+def sample_prompt_length(rng, distribution, mean, max_len):
+    if distribution == "fixed":
+        length = mean
+    elif distribution == "uniform":
+        length = rng.randint(1, 2 * mean)
+    else:
+        # Lognormal with the requested mean and a long tail, like chat traffic
+        sigma = 0.8
+        length = int(rng.lognormvariate(0, sigma) * mean / (2.718281828 ** (sigma ** 2 / 2)))
+    return max(1, min(length, max_len))
+
+def generate_trace(num_requests, rate, arrival="poisson", burstiness=0.25, prefix_share=0.8, num_prefixes=4,
+                   prefix_len=128, prompt_len=32, prompt_len_dist="lognormal", max_new_tokens=16, seed=0) -> List[Dict[str, Any]]:
+    """
+    Returns requests sorted by arrival time (seconds from start). A `prefix_share` fraction of
+    the prompts start with one of `num_prefixes` shared system prompts of `prefix_len` words,
+    followed by a unique part drawn from `prompt_len_dist` around `prompt_len` words.
+    Bursty arrivals use Gamma inter-arrival times with shape `burstiness` (< 1 is burstier than
+    Poisson) and the same mean rate.
+    """
+    rng = random.Random(seed)
+    vocabulary = [word for word in mooncake.tokenizer.get_vocab() if word.isalpha()]
+    prefixes = [[rng.choice(vocabulary) for _ in range(prefix_len)] for _ in range(num_prefixes)]
+    max_prompt = mooncake.model_handle.config.max_position_embeddings // 4
+
+    trace = []
+    now = 0.0
+    for request_id in range(num_requests):
+        if arrival == "bursty":
+            now += rng.gammavariate(burstiness, 1 / (rate * burstiness))
+        else:
+            now += rng.expovariate(rate)
+        prefix = rng.choice(prefixes) if rng.random() < prefix_share else []
+        unique_len = sample_prompt_length(rng, prompt_len_dist, prompt_len, max_prompt)
+        tokens = prefix + [rng.choice(vocabulary) for _ in range(unique_len)]
+        trace.append({"request_id": request_id, "arrival": now, "tokens": tokens, "max_new_tokens": max_new_tokens})
+    return trace
+
+def build_conductor(args) -> Conductor:
+    dim = mooncake.model_handle.config.dim
+    prefill_nodes = []
+    for _ in range(args.prefill_nodes):
+        memory = KVCache(capacity=args.cache_blocks, policy=args.eviction,
+                         storage=BlockPoolStorage(num_pages=args.cache_blocks, page_tokens=kv_block_rows(args.window_size), hidden_size=dim))
+        prefill_nodes.append(PrefillNode(memory, None, window_size=args.window_size))
+    decoding_nodes = [DecodingNode() for _ in range(args.decode_nodes)]
+    admission = None
+    if args.admission:
+        admission = AdmissionController(ttft_slo=args.ttft_slo, tbt_slo=args.tbt_slo, max_defer=args.max_defer)
+    return Conductor(prefill_nodes, decoding_nodes, Messenger(), batch_window=args.batch_window,
+                     max_batch_size=args.max_batch_size, policy=SCHEDULING_POLICIES[args.scheduler](), admission=admission)
+
+async def replay(conductor: Conductor, trace) -> List[Dict[str, Any]]:
+    start = time.perf_counter()
+    records = []
+
+    async def run_request(request):
+        delay = request["arrival"] - (time.perf_counter() - start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        arrived = time.perf_counter()
+        token_times = []
+        record = {"request_id": request["request_id"], "prompt_tokens": len(request["tokens"]), "error": None, "rejected": False}
+        try:
+            await conductor.handle_request(request["tokens"], [], request["max_new_tokens"],
+                                           on_token=lambda token: token_times.append(time.perf_counter()))
+        except RequestRejected as e:
+            record["error"] = str(e)
+            record["rejected"] = True
+        except Exception as e:
+            record["error"] = str(e)
+        finished = time.perf_counter()
+        record["output_tokens"] = len(token_times)
+        record["ttft"] = token_times[0] - arrived if token_times else None
+        record["tbt"] = [later - earlier for earlier, later in zip(token_times, token_times[1:])]
+        record["e2e"] = finished - arrived
+        record["finished"] = finished - start
+        records.append(record)
+
+    await asyncio.gather(*[run_request(request) for request in trace])
+    return records
+
+def report(args, conductor: Conductor, records) -> Dict[str, Any]:
+    completed = [record for record in records if record["error"] is None]
+    makespan = max(record["finished"] for record in records) if records else 0.0
+    output_tokens = sum(record["output_tokens"] for record in completed)
+    prompt_tokens = sum(node.prompt_tokens for node in conductor.prefill_nodes)
+    reused_tokens = sum(node.reused_tokens for node in conductor.prefill_nodes)
+    rejected = sum(1 for record in records if record["rejected"])
+    # Goodput only counts requests whose TTFT and every TBT met the SLOs
+    within_slo = [
+        record for record in completed
+        if record["ttft"] is not None and record["ttft"] <= args.ttft_slo and all(gap <= args.tbt_slo for gap in record["tbt"])
+    ]
+    return {
+        "config": {name: value for name, value in vars(args).items() if name != "output"},
+        "requests": len(records),
+        "completed": len(completed),
+        "rejected": rejected,
+        "failed": len(records) - len(completed) - rejected,
+        "makespan_s": makespan,
+        "throughput": {
+            "requests_per_s": len(completed) / makespan if makespan else 0.0,
+            "output_tokens_per_s": output_tokens / makespan if makespan else 0.0,
+            "goodput_requests_per_s": len(within_slo) / makespan if makespan else 0.0,
+        },
+        "ttft_s": summarize([record["ttft"] for record in completed if record["ttft"] is not None]),
+        "tbt_s": summarize([gap for record in completed for gap in record["tbt"]]),
+        "e2e_s": summarize([record["e2e"] for record in completed]),
+        "cache": {
+            "prompt_tokens": prompt_tokens,
+            "reused_tokens": reused_tokens,
+            "hit_ratio": reused_tokens / prompt_tokens if prompt_tokens else 0.0,
+            "prefill_nodes": [node.cache_stats() for node in conductor.prefill_nodes],
+        },
+        "admission": None if conductor.admission is None else {
+            "admitted": conductor.admission.admitted,
+            "deferred": conductor.admission.deferred,
+            "rejected": conductor.admission.rejected,
+        },
+    }
+
+def use_tiny_model(n_layers=2, dim=128, n_heads=2, hidden_dim=512):
+    # Randomly initialized DistilBERT sharing the real tokenizer's vocabulary, enough to exercise scheduling and caching
+    from transformers import DistilBertConfig, DistilBertForMaskedLM
+    config = DistilBertConfig(n_layers=n_layers, dim=dim, n_heads=n_heads, hidden_dim=hidden_dim,
+                              vocab_size=mooncake.tokenizer.vocab_size, output_hidden_states=True)
+    mooncake.model_handle.set(model=DistilBertForMaskedLM(config))
+
+def configure_model(args):
+    mooncake.model_handle.configure(dtype=args.dtype, quantize=args.quantize, inference_mode=args.inference_mode)
+    if args.tiny_model:
+        use_tiny_model()
+
+def build_parser(description=__doc__):
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    trace = parser.add_argument_group("trace")
+    trace.add_argument("--requests", type=int, default=100)
+    trace.add_argument("--rate", type=float, default=10.0, help="mean arrival rate in requests/s")
+    trace.add_argument("--arrival", choices=["poisson", "bursty"], default="poisson")
+    trace.add_argument("--burstiness", type=float, default=0.25, help="Gamma shape for bursty arrivals")
+    trace.add_argument("--prefix-share", type=float, default=0.8, help="fraction of requests with a shared prefix")
+    trace.add_argument("--num-prefixes", type=int, default=4)
+    trace.add_argument("--prefix-len", type=int, default=96, help="shared prefix length in words")
+    trace.add_argument("--prompt-len", type=int, default=24, help="mean unique prompt length in words")
+    trace.add_argument("--prompt-len-dist", choices=["fixed", "uniform", "lognormal"], default="lognormal")
+    trace.add_argument("--max-new-tokens", type=int, default=16)
+    trace.add_argument("--seed", type=int, default=0)
+    cluster = parser.add_argument_group("cluster")
+    cluster.add_argument("--prefill-nodes", type=int, default=2)
+    cluster.add_argument("--decode-nodes", type=int, default=2)
+    cluster.add_argument("--scheduler", choices=sorted(SCHEDULING_POLICIES), default="cache_aware")
+    cluster.add_argument("--eviction", choices=["lru", "lfu", "arc", "prefix"], default="lru")
+    cluster.add_argument("--cache-blocks", type=int, default=2048)
+    cluster.add_argument("--window-size", type=int, default=3)
+    cluster.add_argument("--batch-window", type=float, default=0.005)
+    cluster.add_argument("--max-batch-size", type=int, default=16)
+    slo = parser.add_argument_group("slo")
+    slo.add_argument("--ttft-slo", type=float, default=2.0, help="seconds, used for goodput and --admission")
+    slo.add_argument("--tbt-slo", type=float, default=0.2, help="seconds, used for goodput and --admission")
+    slo.add_argument("--admission", action="store_true", help="defer or reject requests predicted to miss the SLOs")
+    slo.add_argument("--max-defer", type=float, default=0.5, help="seconds a request may be deferred before rejection")
+    model = parser.add_argument_group("model")
+    model.add_argument("--tiny-model", action="store_true", help="swap in a small random DistilBERT")
+    model.add_argument("--dtype", choices=["float32", "bfloat16"], default=None, help="load the model in this dtype")
+    model.add_argument("--quantize", action="store_true", help="int8 dynamic quantization of the model's Linear layers")
+    model.add_argument("--inference-mode", action="store_true", help="run forwards under torch.inference_mode")
+    parser.add_argument("--output", default=None, help="write the JSON report here")
+    parser.add_argument("--verbose", action="store_true", help="keep mooncake's per-call INFO logs")
+    parser.add_argument("--trace", default=None, help="record spans to this file, JSON lines if it ends in .jsonl else Chrome trace format")
+    return parser
+
+def parse_args(argv=None):
+    return build_parser().parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.verbose:
+        logging.getLogger(mooncake.__name__).setLevel(logging.WARNING)
+    configure_model(args)
+
+    trace = generate_trace(args.requests, args.rate, args.arrival, args.burstiness, args.prefix_share,
+                           args.num_prefixes, args.prefix_len, args.prompt_len, args.prompt_len_dist,
+                           args.max_new_tokens, args.seed)
+    conductor = build_conductor(args)
+    if args.trace:
+        mooncake.tracer.set_sink(JSONLSink(args.trace) if args.trace.endswith(".jsonl") else ChromeTraceSink(args.trace))
+    try:
+        records = asyncio.run(replay(conductor, trace))
+    finally:
+        mooncake.tracer.set_sink(None)
+    results = report(args, conductor, records)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
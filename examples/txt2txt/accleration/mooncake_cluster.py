@@ -0,0 +1,419 @@
+"""
+Multi-process launcher for the mooncake.py pipeline on one machine.
+
+Spawns N prefill and M decode worker processes, each loading the model once and serving a
+JSON-lines RPC endpoint on a Unix socket. Decode workers also run a KVTransferServer, so a
+prefill worker pushes a request's blocks and prompt keys/values straight to the decode worker
+the Conductor paired it with. The Conductor stays in the launcher and only sees tokens.
+Replays the same synthetic trace as mooncake_bench.py and prints the same JSON report, which
+makes it possible to measure how disaggregation scales across cores:
+
+    python mooncake_cluster.py --tiny-model --prefill-nodes 2 --decode-nodes 2 --requests 200 --rate 20
+
+SIGINT/SIGTERM drain the cluster gracefully: new requests are rejected, in-flight ones finish,
+then every worker stops accepting work, completes what it holds and exits.
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import time
+from typing import List, Dict, Any
+
+import torch
+
+import mooncake
+import mooncake_bench
+from mooncake import (
+    AdmissionController, BlockPoolStorage, ChromeTraceSink, Conductor, DecodingNode, JSONLSink, KVCache, KVTransferServer, Messenger, PrefillBatcher,
+    PrefillNode, PROMPT_KV_KEY, RadixTree, RequestRejected, current_request_id, kv_block_rows, prompt_kv_key,
+)
+
+logger = logging.getLogger(__name__)
+
+# Token lists of long prompts exceed asyncio's default 64 KiB line limit
+RPC_LINE_LIMIT = 2 ** 24
+
+class WorkerServer:
+    """
+    JSON-lines RPC endpoint of one worker process. Each connection carries one request line
+    {"op": ..., ...}; the handler for `op` is an async generator whose messages are written
+    back one line each, an exception is sent as {"error": ...}. A "drain" request stops new
+    connections and resolves `drained` once every in-flight handler has finished.
+    """
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.server = None
+        self.in_flight = set()
+        self.drained = asyncio.Event()
+
+    async def start(self, path: str):
+        self.server = await asyncio.start_unix_server(self._handle, path=path, limit=RPC_LINE_LIMIT)
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self.in_flight.add(task)
+        try:
+            request = json.loads(await reader.readline())
+            if request["op"] == "drain":
+                asyncio.create_task(self.drain())
+                messages = self._reply({"draining": True})
+            else:
+                messages = self.handlers[request["op"]](request)
+            try:
+                async for message in messages:
+                    writer.write(json.dumps(message).encode() + b"\n")
+                    await writer.drain()
+            except Exception as e:
+                logger.info(f"Error handling {request['op']}: {str(e)}")
+                writer.write(json.dumps({"error": str(e)}).encode() + b"\n")
+                await writer.drain()
+        finally:
+            self.in_flight.discard(task)
+            writer.close()
+
+    async def _reply(self, message):
+        yield message
+
+    async def drain(self):
+        if self.server is not None:
+            self.server.close()
+        pending = self.in_flight - {asyncio.current_task()}
+        if pending:
+            await asyncio.wait(pending)
+        self.drained.set()
+
+class WorkerClient:
+    # Conductor-side handle of a worker's RPC endpoint, one connection per call
+    def __init__(self, rpc_path: str):
+        self.rpc_path = rpc_path
+
+    async def stream(self, op: str, **params):
+        reader, writer = await asyncio.open_unix_connection(self.rpc_path, limit=RPC_LINE_LIMIT)
+        try:
+            writer.write(json.dumps({"op": op, **params}).encode() + b"\n")
+            await writer.drain()
+            while line := await reader.readline():
+                message = json.loads(line)
+                if "error" in message:
+                    raise RuntimeError(message["error"])
+                yield message
+        finally:
+            writer.close()
+
+    async def call(self, op: str, **params) -> Dict[str, Any]:
+        message = None
+        async for message in self.stream(op, **params):
+            pass
+        return message
+
+class RemotePrefillNode(WorkerClient):
+    """
+    Stands in for a PrefillNode in the Conductor. The scheduling attributes mirror the local
+    node's; cached_prefix_length answers from a shadow RadixTree of the prompts sent to the
+    worker, so it does not see the worker's evictions and may overestimate reuse.
+    """
+    def __init__(self, rpc_path: str, window_size: int):
+        super().__init__(rpc_path)
+        self.window_size = window_size
+        self.prefix_tree = RadixTree(block_size=window_size)
+        self.current_load = 0
+        self.queued_tokens = 0
+        self.seconds_per_token = None
+        self.prompt_tokens = 0
+        self.reused_tokens = 0
+        self.stats = {}
+
+    def cached_prefix_length(self, input_tokens) -> int:
+        return len(self.prefix_tree.match_prefix(input_tokens)) * self.window_size
+
+    def cache_stats(self) -> Dict[str, Any]:
+        return self.stats
+
+    async def prefill(self, input_tokens, request_id, kv_address) -> str:
+        # Returns the key the prompt keys/values were stored under on the decode worker
+        reply = await self.call("prefill", tokens=input_tokens, request_id=request_id, kv_address=kv_address)
+        self.prefix_tree.insert(input_tokens)
+        self.seconds_per_token = reply["seconds_per_token"]
+        self.prompt_tokens = reply["prompt_tokens"]
+        self.reused_tokens = reply["reused_tokens"]
+        return reply["prompt_key"]
+
+    async def refresh_stats(self):
+        self.stats = (await self.call("stats"))["cache"]
+
+class RemoteDecodingNode(WorkerClient):
+    def __init__(self, rpc_path: str, kv_address: str):
+        super().__init__(rpc_path)
+        self.kv_address = kv_address
+        self.current_load = 0
+        self.step_seconds = None
+
+    async def decode(self, tokens, prompt_key, max_new_tokens=16, on_token=None) -> List[str]:
+        decoded_tokens = []
+        async for message in self.stream("decode", tokens=tokens, prompt_key=prompt_key, max_new_tokens=max_new_tokens):
+            if "token" in message:
+                decoded_tokens.append(message["token"])
+                if on_token is not None:
+                    on_token(message["token"])
+            else:
+                self.step_seconds = message["step_seconds"]
+        return decoded_tokens
+
+    async def discard(self, prompt_key):
+        # Best effort, a worker that is gone or draining takes its inbox with it
+        try:
+            await self.call("discard", prompt_key=prompt_key)
+        except (OSError, RuntimeError) as e:
+            logger.info(f"Could not discard {prompt_key}: {str(e)}")
+
+class ClusterConductor(Conductor):
+    """
+    Conductor over worker processes. Scheduling and admission are inherited; the decoding
+    node is paired before prefill so the prefill worker can push the KV data to it directly.
+    Batching happens inside each prefill worker.
+    """
+    def __init__(self, prefill_nodes: List[RemotePrefillNode], decoding_nodes: List[RemoteDecodingNode], policy=None,
+                 admission: AdmissionController = None):
+        super().__init__(prefill_nodes, decoding_nodes, messenger=None, policy=policy, admission=admission)
+        self.draining = False
+        self.in_flight = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    async def _handle_request(self, input_tokens, reusable_block_ids, max_new_tokens, on_token):
+        if self.draining:
+            raise RequestRejected("Cluster is draining")
+        self.in_flight += 1
+        self.idle.clear()
+        try:
+            if self.admission is not None:
+                selected_prefill_node, selected_decoding_node = await self.admission.admit(self, input_tokens)
+            else:
+                selected_prefill_node = self.select_prefill_node(input_tokens)
+                selected_decoding_node = self.select_decoding_node(input_tokens)
+            uncached_tokens = len(input_tokens) - selected_prefill_node.cached_prefix_length(input_tokens)
+            selected_prefill_node.current_load += 1
+            selected_prefill_node.queued_tokens += uncached_tokens
+            selected_decoding_node.current_load += 1
+            try:
+                try:
+                    prompt_key = await selected_prefill_node.prefill(input_tokens, current_request_id.get(), selected_decoding_node.kv_address)
+                finally:
+                    selected_prefill_node.current_load -= 1
+                    selected_prefill_node.queued_tokens -= uncached_tokens
+                decoded_tokens = await selected_decoding_node.decode(input_tokens, prompt_key, max_new_tokens, on_token)
+            except BaseException:
+                # The prefill worker may have pushed the prompt keys/values before the request failed
+                await selected_decoding_node.discard(prompt_kv_key(current_request_id.get()))
+                raise
+            finally:
+                selected_decoding_node.current_load -= 1
+            logger.info(f"Decoded tokens: {decoded_tokens}")
+            return decoded_tokens
+        finally:
+            self.in_flight -= 1
+            if not self.in_flight:
+                self.idle.set()
+
+    def start_drain(self):
+        # From here on every new request is rejected
+        if not self.draining:
+            logger.warning("Draining cluster, rejecting new requests")
+        self.draining = True
+
+    async def drain(self):
+        # Stop admitting, let in-flight requests finish, then drain every worker
+        self.start_drain()
+        await self.idle.wait()
+        # A worker that already got SIGTERM itself is draining or gone and refuses the connection
+        await asyncio.gather(*[node.call("drain") for node in self.prefill_nodes + self.decoding_nodes], return_exceptions=True)
+
+def build_worker_model(config):
+    mooncake.model_handle.configure(dtype=config["dtype"], quantize=config["quantize"], inference_mode=config["inference_mode"])
+    if config["tiny_model"]:
+        # Same seed in every process, prefill and decode workers must share weights
+        torch.manual_seed(config["seed"])
+        mooncake_bench.use_tiny_model()
+
+async def serve_prefill(rpc_path: str, config: Dict[str, Any], ready):
+    dim = mooncake.model_handle.config.dim
+    memory = KVCache(capacity=config["cache_blocks"], policy=config["eviction"],
+                     storage=BlockPoolStorage(num_pages=config["cache_blocks"], page_tokens=kv_block_rows(config["window_size"]), hidden_size=dim))
+    node = PrefillNode(memory, None, window_size=config["window_size"])
+    batcher = PrefillBatcher(node, config["batch_window"], config["max_batch_size"])
+    messenger = Messenger()
+
+    async def prefill(request):
+        current_request_id.set(request["request_id"])
+        kv_data = await batcher.submit(request["tokens"], [])
+        prompt_key = prompt_kv_key(request["request_id"])
+        await messenger.transfer_kv_cache_socket(request["kv_address"], {prompt_key: kv_data[PROMPT_KV_KEY]})
+        yield {"prompt_key": prompt_key, "seconds_per_token": node.seconds_per_token,
+               "prompt_tokens": node.prompt_tokens, "reused_tokens": node.reused_tokens}
+
+    async def stats(request):
+        yield {"cache": node.cache_stats()}
+
+    server = WorkerServer({"prefill": prefill, "stats": stats})
+    await server.start(rpc_path)
+    # SIGTERM drains the worker like a drain request
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(server.drain()))
+    ready.put(rpc_path)
+    await server.drained.wait()
+    await messenger.close()
+
+async def serve_decode(rpc_path: str, kv_path: str, config: Dict[str, Any], ready):
+    node = DecodingNode()
+    # Prefill workers push the prompt keys/values straight into the node's inbox
+    kv_server = KVTransferServer(node.cpu_memory)
+    await kv_server.start(unix_path=kv_path)
+
+    async def decode(request):
+        past_key_values = node.cpu_memory.take(request["prompt_key"])
+        node.current_load += 1
+        try:
+            async for token in node.generate(request["tokens"], past_key_values, request["max_new_tokens"]):
+                yield {"token": token}
+        finally:
+            node.current_load -= 1
+        yield {"step_seconds": node.step_seconds}
+
+    async def discard(request):
+        node.cpu_memory.discard(request["prompt_key"])
+        yield {"discarded": request["prompt_key"]}
+
+    async def stats(request):
+        yield {"cache": node.cpu_memory.stats()}
+
+    server = WorkerServer({"decode": decode, "discard": discard, "stats": stats})
+    await server.start(rpc_path)
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(server.drain()))
+    ready.put(rpc_path)
+    await server.drained.wait()
+    await kv_server.stop()
+
+def run_worker(role: str, rpc_path: str, kv_path: str, config: Dict[str, Any], ready):
+    # The launcher coordinates shutdown, a Ctrl-C reaching the whole process group must not kill workers mid-request
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.getLogger(mooncake.__name__).setLevel(logging.INFO if config["verbose"] else logging.WARNING)
+    build_worker_model(config)
+    torch.set_num_threads(config["threads_per_worker"])
+
+    if role == "prefill":
+        asyncio.run(serve_prefill(rpc_path, config, ready))
+    else:
+        asyncio.run(serve_decode(rpc_path, kv_path, config, ready))
+
+class Cluster:
+    """
+    Owns the worker processes and their socket directory. start() spawns them and waits until
+    every endpoint is listening, stop() joins them after a drain and cleans up.
+    """
+    def __init__(self, num_prefill: int, num_decode: int, config: Dict[str, Any], socket_dir: str = None):
+        self.num_prefill = num_prefill
+        self.num_decode = num_decode
+        self.config = config
+        self.socket_dir = socket_dir if socket_dir is not None else tempfile.mkdtemp(prefix="mooncake-")
+        self.processes = []
+        self.prefill_nodes = []
+        self.decoding_nodes = []
+
+    def start(self, timeout: float = 300.0):
+        context = multiprocessing.get_context("spawn")
+        ready = context.Queue()
+        try:
+            for role, count in (("prefill", self.num_prefill), ("decode", self.num_decode)):
+                for i in range(count):
+                    rpc_path = os.path.join(self.socket_dir, f"{role}-{i}.sock")
+                    kv_path = os.path.join(self.socket_dir, f"{role}-{i}.kv.sock")
+                    process = context.Process(target=run_worker, args=(role, rpc_path, kv_path, self.config, ready),
+                                              name=f"mooncake-{role}-{i}", daemon=True)
+                    process.start()
+                    self.processes.append(process)
+                    if role == "prefill":
+                        self.prefill_nodes.append(RemotePrefillNode(rpc_path, self.config["window_size"]))
+                    else:
+                        self.decoding_nodes.append(RemoteDecodingNode(rpc_path, kv_path))
+            deadline = time.monotonic() + timeout
+            for _ in self.processes:
+                ready.get(timeout=max(deadline - time.monotonic(), 0.1))
+        except BaseException:
+            # A worker that failed to come up, a timeout or Ctrl-C: the started workers would wait for a drain forever
+            self.stop(timeout=0)
+            raise
+        logger.info(f"Started {self.num_prefill} prefill and {self.num_decode} decode workers in {self.socket_dir}")
+
+    def stop(self, timeout: float = 30.0):
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.info(f"Worker {process.name} did not drain in {timeout}s, terminating")
+                process.terminate()
+                process.join()
+        self.processes.clear()
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+async def run(cluster: Cluster, conductor: ClusterConductor, trace) -> List[Dict[str, Any]]:
+    # A signal only stops admission, the rest of the trace is rejected as it arrives
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, conductor.start_drain)
+    records = await mooncake_bench.replay(conductor, trace)
+    await asyncio.gather(*[node.refresh_stats() for node in cluster.prefill_nodes], return_exceptions=True)
+    await conductor.drain()
+    return records
+
+def parse_args(argv=None):
+    parser = mooncake_bench.build_parser(__doc__)
+    workers = parser.add_argument_group("workers")
+    workers.add_argument("--threads-per-worker", type=int, default=max(1, (os.cpu_count() or 1) // 4),
+                         help="torch intra-op threads in each worker process")
+    workers.add_argument("--socket-dir", default=None, help="directory for the workers' Unix sockets, a temporary one by default")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    level = logging.INFO if args.verbose else logging.WARNING
+    logging.getLogger(mooncake.__name__).setLevel(level)
+    logger.setLevel(level)
+    config = {
+        name: getattr(args, name)
+        for name in ("tiny_model", "dtype", "quantize", "inference_mode", "seed", "cache_blocks", "window_size", "eviction", "batch_window", "max_batch_size",
+                     "threads_per_worker", "verbose")
+    }
+    # The launcher only needs the tokenizer and model config to build the trace, the weights load in the workers
+    if args.tiny_model:
+        build_worker_model(config)
+    trace = mooncake_bench.generate_trace(args.requests, args.rate, args.arrival, args.burstiness, args.prefix_share,
+                                          args.num_prefixes, args.prefix_len, args.prompt_len, args.prompt_len_dist,
+                                          args.max_new_tokens, args.seed)
+
+    cluster = Cluster(args.prefill_nodes, args.decode_nodes, config, args.socket_dir)
+    try:
+        cluster.start()
+        if args.trace:
+            # Request, admission and transfer spans of the Conductor, workers do not trace
+            mooncake.tracer.set_sink(JSONLSink(args.trace) if args.trace.endswith(".jsonl") else ChromeTraceSink(args.trace))
+        admission = None
+        if args.admission:
+            admission = AdmissionController(ttft_slo=args.ttft_slo, tbt_slo=args.tbt_slo, max_defer=args.max_defer)
+        conductor = ClusterConductor(cluster.prefill_nodes, cluster.decoding_nodes,
+                                     policy=mooncake_bench.SCHEDULING_POLICIES[args.scheduler](), admission=admission)
+        records = asyncio.run(run(cluster, conductor, trace))
+    finally:
+        mooncake.tracer.set_sink(None)
+        cluster.stop()
+    results = mooncake_bench.report(args, conductor, records)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
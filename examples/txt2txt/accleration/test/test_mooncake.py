@@ -0,0 +1,74 @@
+import asyncio
+import os
+import sys
+import unittest
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from mooncake import KVCache, KVTransferClient, KVTransferServer, LRUPolicy, PrefixAwarePolicy, RadixTree, ShardedKVCache
+
+
+class PrefixEvictionTest(unittest.TestCase):
+    def setUp(self):
+        self.tree = RadixTree(block_size=1)
+        self.chain = [node.key for node in self.tree.insert([f"w{i}" for i in range(8)])]
+
+    def test_parents_outlive_children(self):
+        policy = PrefixAwarePolicy(self.tree)
+        cache = KVCache(capacity=8, policy=policy)
+
+        async def fill():
+            await cache.put_many((key, torch.zeros(1)) for key in self.chain)
+            # Unrelated blocks push half of the chain out, leaves first
+            await cache.put_many((f"other-{i}", torch.zeros(1)) for i in range(4))
+        asyncio.run(fill())
+        self.assertEqual([key in cache for key in self.chain], [True] * 4 + [False] * 4)
+
+    def test_sharded_prefix_chain_is_rejected(self):
+        # A chain's blocks hash into different shards, none of them sees a parent's children
+        with self.assertRaises(ValueError):
+            ShardedKVCache(num_shards=4, capacity=8, policy="prefix")
+        with self.assertRaises(ValueError):
+            ShardedKVCache(num_shards=4, capacity=8, policy=PrefixAwarePolicy)
+
+    def test_sharded_policies_are_per_shard(self):
+        cache = ShardedKVCache(num_shards=4, capacity=8, policy=LRUPolicy)
+        self.assertEqual(len({id(shard.policy) for shard in cache.shards}), 4)
+        with self.assertRaises(TypeError):
+            ShardedKVCache(num_shards=4, capacity=8, policy=LRUPolicy())
+
+
+class FailingDestination:
+    def __init__(self):
+        self.fail = True
+        self.cache = KVCache(capacity=8)
+
+    async def put_many(self, items):
+        if self.fail:
+            raise RuntimeError("store failed")
+        await self.cache.put_many(items)
+
+
+class KVTransferTest(unittest.TestCase):
+    def test_failed_store_is_not_acknowledged(self):
+        async def transfer():
+            destination = FailingDestination()
+            server = KVTransferServer(destination)
+            host, port = await server.start()
+            client = KVTransferClient(host, port)
+            try:
+                with self.assertRaises(ConnectionError):
+                    await client.send({"block": torch.arange(4.0)})
+                # The failed message closed the connection, the next send reconnects
+                destination.fail = False
+                await client.send({"block": torch.arange(4.0)})
+                self.assertTrue(torch.equal(await destination.cache.get("block"), torch.arange(4.0)))
+            finally:
+                await client.close()
+                await server.stop()
+        asyncio.run(transfer())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,45 @@
+import argparse
+import itertools
+import os
+import random
+import sys
+import time
 import torch
-import triton
-import triton.language as tl
 import numpy as np
-import pycuda.driver as cuda
-import pycuda.autoinit
-from pycuda.compiler import SourceModule
+
+import kernel_bench
+
+# Triton's interpreter runs @triton.jit kernels on CPU tensors through NumPy. The choice is made when
+# the kernels are decorated, so triton is imported on first use by load_triton, after the CLI's
+# --interpret had its say, rather than when this module is imported
+triton = tl = None
+INTERPRET = False
+_triton_loaded = False
+
+def load_triton(interpret=None):
+    # Returns the triton module, None if it is not installed. Only the first call imports it and
+    # decorates the kernels, `interpret` (default: TRITON_INTERPRET from the environment) applies to that call
+    global triton, tl, INTERPRET, _triton_loaded
+    if not _triton_loaded:
+        _triton_loaded = True
+        if interpret:
+            os.environ["TRITON_INTERPRET"] = "1"
+        INTERPRET = os.environ.get("TRITON_INTERPRET") == "1"
+        try:
+            import triton
+            import triton.language as tl
+        except ImportError:
+            return None
+        define_triton_kernels()
+    return triton
+
+# GPU backends are optional plugins, each is skipped when its toolkit or a CUDA device is missing
+try:
+    import pycuda.driver as cuda
+    import pycuda.autoinit
+    from pycuda.compiler import SourceModule
+except Exception:  # ImportError, or pycuda.autoinit finding no CUDA device
+    cuda = None
 
 # 1. PyTorch Implementation using custom CUDA backend
 class MatmulCUDAFunction(torch.autograd.Function):
@@ -61,216 +96,620 @@ __global__ void matmul_kernel_optimized(float* __restrict__ a,
 """
 
 # 3. Optimized Triton Implementation with similar tiling strategy
-@triton.jit
-def matmul_kernel_optimized(
-    a_ptr, b_ptr, c_ptr,
-    M, N, K,
-    BLOCK_SIZE_M: tl.constexpr, 
-    BLOCK_SIZE_N: tl.constexpr, 
-    BLOCK_SIZE_K: tl.constexpr,
-    stride_am, stride_ak,
-    stride_bk, stride_bn,
-    stride_cm, stride_cn,
-):
-    # Similar tiling strategy as CUDA kernel
-    pid = tl.program_id(axis=0)
-    num_pid_m = tl.cdiv(M, BLOCK_SIZE_M)
-    num_pid_n = tl.cdiv(N, BLOCK_SIZE_N)
+def define_triton_kernels():
+    global matmul_kernel_optimized, matmul_epilogue_kernel
+
+    @triton.jit
+    def matmul_kernel_optimized(
+        a_ptr, b_ptr, c_ptr,
+        M, N, K,
+        BLOCK_SIZE_M: tl.constexpr, 
+        BLOCK_SIZE_N: tl.constexpr, 
+        BLOCK_SIZE_K: tl.constexpr,
+        stride_am, stride_ak,
+        stride_bk, stride_bn,
+        stride_cm, stride_cn,
+        INPUT_PRECISION: tl.constexpr = "tf32",
+    ):
+        # Similar tiling strategy as CUDA kernel
+        pid = tl.program_id(axis=0)
+        num_pid_m = tl.cdiv(M, BLOCK_SIZE_M)
+        num_pid_n = tl.cdiv(N, BLOCK_SIZE_N)
     
-    # 2D grid ordering
-    pid_m = pid // num_pid_n
-    pid_n = pid % num_pid_n
-
-    # Block offset with boundary checking
-    offs_am = tl.arange(0, BLOCK_SIZE_M)
-    offs_bn = tl.arange(0, BLOCK_SIZE_N)
-    offs_k = tl.arange(0, BLOCK_SIZE_K)
+        # 2D grid ordering
+        pid_m = pid // num_pid_n
+        pid_n = pid % num_pid_n
+
+        # Block offset with boundary checking
+        offs_am = tl.arange(0, BLOCK_SIZE_M)
+        offs_bn = tl.arange(0, BLOCK_SIZE_N)
+        offs_k = tl.arange(0, BLOCK_SIZE_K)
     
-    # Add offsets
-    offs_am = pid_m * BLOCK_SIZE_M + offs_am
-    offs_bn = pid_n * BLOCK_SIZE_N + offs_bn
+        # Add offsets
+        offs_am = pid_m * BLOCK_SIZE_M + offs_am
+        offs_bn = pid_n * BLOCK_SIZE_N + offs_bn
 
-    # Initialize accumulator with higher precision
-    accumulator = tl.zeros((BLOCK_SIZE_M, BLOCK_SIZE_N), dtype=tl.float32)
+        # Initialize accumulator with higher precision
+        accumulator = tl.zeros((BLOCK_SIZE_M, BLOCK_SIZE_N), dtype=tl.float32)
     
-    # Pointers to shared memory blocks
-    for k in range(0, tl.cdiv(K, BLOCK_SIZE_K)):
-        k_idx = k * BLOCK_SIZE_K + offs_k
-        # Boundary masks for A and B
-        mask_a = (offs_am[:, None] < M) & (k_idx[None, :] < K)
-        mask_b = (k_idx[:, None] < K) & (offs_bn[None, :] < N)
+        # Pointers to shared memory blocks
+        for k in range(0, tl.cdiv(K, BLOCK_SIZE_K)):
+            k_idx = k * BLOCK_SIZE_K + offs_k
+            # Boundary masks for A and B
+            mask_a = (offs_am[:, None] < M) & (k_idx[None, :] < K)
+            mask_b = (k_idx[:, None] < K) & (offs_bn[None, :] < N)
         
-        # Load blocks with boundary checking and zero padding
-        a = tl.load(a_ptr + offs_am[:, None] * stride_am + k_idx[None, :] * stride_ak, 
-                   mask=mask_a, other=0.0)
-        b = tl.load(b_ptr + k_idx[:, None] * stride_bk + offs_bn[None, :] * stride_bn, 
-                   mask=mask_b, other=0.0)
+            # Load blocks with boundary checking and zero padding
+            a = tl.load(a_ptr + offs_am[:, None] * stride_am + k_idx[None, :] * stride_ak, 
+                       mask=mask_a, other=0.0)
+            b = tl.load(b_ptr + k_idx[:, None] * stride_bk + offs_bn[None, :] * stride_bn, 
+                       mask=mask_b, other=0.0)
         
-        # Accumulate with higher precision
-        accumulator += tl.dot(a, b)
+            # Accumulate with higher precision, float32 operands are rounded to TF32 on GPUs unless INPUT_PRECISION is "ieee"
+            accumulator += tl.dot(a, b, input_precision=INPUT_PRECISION)
 
-    # Store results with boundary checking
-    mask_c = (offs_am[:, None] < M) & (offs_bn[None, :] < N)
-    c_ptrs = c_ptr + offs_am[:, None] * stride_cm + offs_bn[None, :] * stride_cn
-    tl.store(c_ptrs, accumulator, mask=mask_c)
+        # Store results with boundary checking
+        mask_c = (offs_am[:, None] < M) & (offs_bn[None, :] < N)
+        c_ptrs = c_ptr + offs_am[:, None] * stride_cm + offs_bn[None, :] * stride_cn
+        tl.store(c_ptrs, accumulator, mask=mask_c)
 
-def benchmark_comparison():
-    print("Starting benchmark comparison...")
-    
-    # Common parameters for all implementations
-    BLOCK_SIZE = 32
-    NUM_WARMUP = 20  # Increased warmup iterations
-    NUM_ITERATIONS = 100
-    DTYPE = torch.float32
-    RTOL = 1e-2  # Relaxed tolerance
-    ATOL = 1e-2
+    @triton.jit
+    def matmul_epilogue_kernel(
+        a_ptr, b_ptr, c_ptr, bias_ptr, residual_ptr,
+        M, N, K,
+        stride_am, stride_ak,
+        stride_bk, stride_bn,
+        stride_cm, stride_cn,
+        stride_rm, stride_rn,
+        BLOCK_SIZE_M: tl.constexpr,
+        BLOCK_SIZE_N: tl.constexpr,
+        BLOCK_SIZE_K: tl.constexpr,
+        HAS_BIAS: tl.constexpr,
+        ACTIVATION: tl.constexpr,
+        HAS_RESIDUAL: tl.constexpr,
+    ):
+        # matmul_kernel_optimized with bias, activation and residual applied to the accumulator
+        # before the one store, so the output tile goes to memory once instead of once per op
+        pid = tl.program_id(axis=0)
+        num_pid_n = tl.cdiv(N, BLOCK_SIZE_N)
+        pid_m = pid // num_pid_n
+        pid_n = pid % num_pid_n
 
-    # Test different matrix sizes
-    sizes = [
-        (1024, 1024, 1024),
-        (2048, 2048, 2048),
-        (4096, 4096, 4096)
-    ]
+        offs_am = pid_m * BLOCK_SIZE_M + tl.arange(0, BLOCK_SIZE_M)
+        offs_bn = pid_n * BLOCK_SIZE_N + tl.arange(0, BLOCK_SIZE_N)
+        offs_k = tl.arange(0, BLOCK_SIZE_K)
 
-    for M, N, K in sizes:
-        print(f"\nBenchmarking size: {M}x{N}x{K}")
-        
-        # Initialize matrices with controlled values
-        torch.manual_seed(0)
-        # Use smaller values to reduce numerical errors
-        a = torch.randn(M, K, device='cuda', dtype=DTYPE) * 0.01
-        b = torch.randn(K, N, device='cuda', dtype=DTYPE) * 0.01
-
-        # Compute reference result with PyTorch
-        reference = torch.mm(a, b)
-
-        print("Performing warmup runs...")
-        # Warmup all implementations
-        for i in range(NUM_WARMUP):
-            warmup_result = torch.mm(a, b)
-            # Verify first warmup iteration
-            if i == 0:  # Changed from comparing tensor to comparing iteration count
-                assert torch.allclose(warmup_result, reference, rtol=RTOL, atol=ATOL), "PyTorch warmup inconsistent"
-        torch.cuda.synchronize()
-
-        # 1. PyTorch Implementation
-        pytorch_times = []
-        c_pytorch = None
-        print("\nRunning PyTorch implementation...")
-        for i in range(NUM_ITERATIONS):
-            start = torch.cuda.Event(enable_timing=True)
-            end = torch.cuda.Event(enable_timing=True)
-            start.record()
-            c_pytorch = MatmulCUDAFunction.apply(a, b)
-            end.record()
-            torch.cuda.synchronize()
-            pytorch_times.append(start.elapsed_time(end))
-            
-            # Verify consistency every 10 iterations
-            if i % 10 == 0:
-                assert torch.allclose(c_pytorch, reference, rtol=RTOL, atol=ATOL), \
-                    f"PyTorch result mismatch at iteration {i}"
-
-        # 2. CUDA Implementation
-        print("\nRunning CUDA implementation...")
-        mod = SourceModule(cuda_kernel)
-        matmul_cuda = mod.get_function("matmul_kernel_optimized")
-        
-        # Allocate memory
-        a_cpu = a.detach().cpu().numpy()
-        b_cpu = b.detach().cpu().numpy()
-        c_cpu = np.empty((M, N), dtype=np.float32)
-        
-        a_gpu = cuda.mem_alloc(a_cpu.nbytes)
-        b_gpu = cuda.mem_alloc(b_cpu.nbytes)
-        c_gpu = cuda.mem_alloc(c_cpu.nbytes)
-        
-        cuda.memcpy_htod(a_gpu, a_cpu)
-        cuda.memcpy_htod(b_gpu, b_cpu)
-        
-        cuda_times = []
-        c_cuda = None
-        for i in range(NUM_ITERATIONS):
-            start = cuda.Event()
-            end = cuda.Event()
-            start.record()
-            
-            matmul_cuda(
-                a_gpu, b_gpu, c_gpu,
-                np.int32(M), np.int32(N), np.int32(K),
-                block=(BLOCK_SIZE, BLOCK_SIZE, 1),
-                grid=((N + BLOCK_SIZE - 1) // BLOCK_SIZE,
-                     (M + BLOCK_SIZE - 1) // BLOCK_SIZE)
-            )
-            
-            end.record()
-            end.synchronize()
-            cuda_times.append(start.time_till(end))
-            
-            # Verify every 10 iterations
-            if i % 10 == 0:
-                cuda.memcpy_dtoh(c_cpu, c_gpu)
-                c_cuda = torch.from_numpy(c_cpu).cuda()
-                try:
-                    assert torch.allclose(c_cuda, reference, rtol=RTOL, atol=ATOL), \
-                        f"CUDA result mismatch at iteration {i}"
-                except AssertionError as e:
-                    print(f"CUDA verification failed at iteration {i}")
-                    max_diff = torch.max(torch.abs(reference - c_cuda))
-                    print(f"Maximum absolute difference: {max_diff.item()}")
-                    cuda_times = []  # Invalidate results
-                    break
-
-        # 3. Triton Implementation
-        print("\nRunning Triton implementation...")
-        triton_times = []
-        c_triton = torch.empty((M, N), device='cuda', dtype=DTYPE)
-        grid = (triton.cdiv(M, BLOCK_SIZE) * triton.cdiv(N, BLOCK_SIZE),)
-        
-        for i in range(NUM_ITERATIONS):
-            start = torch.cuda.Event(enable_timing=True)
-            end = torch.cuda.Event(enable_timing=True)
-            start.record()
-            matmul_kernel_optimized[grid](
-                a_ptr=a, b_ptr=b, c_ptr=c_triton,
-                M=M, N=N, K=K,
-                BLOCK_SIZE_M=BLOCK_SIZE,
-                BLOCK_SIZE_N=BLOCK_SIZE,
-                BLOCK_SIZE_K=BLOCK_SIZE,
-                stride_am=K, stride_ak=1,
-                stride_bk=N, stride_bn=1,
-                stride_cm=N, stride_cn=1,
+        accumulator = tl.zeros((BLOCK_SIZE_M, BLOCK_SIZE_N), dtype=tl.float32)
+        for k in range(0, tl.cdiv(K, BLOCK_SIZE_K)):
+            k_idx = k * BLOCK_SIZE_K + offs_k
+            mask_a = (offs_am[:, None] < M) & (k_idx[None, :] < K)
+            mask_b = (k_idx[:, None] < K) & (offs_bn[None, :] < N)
+            a = tl.load(a_ptr + offs_am[:, None] * stride_am + k_idx[None, :] * stride_ak,
+                       mask=mask_a, other=0.0)
+            b = tl.load(b_ptr + k_idx[:, None] * stride_bk + offs_bn[None, :] * stride_bn,
+                       mask=mask_b, other=0.0)
+            accumulator += tl.dot(a, b)
+
+        mask_c = (offs_am[:, None] < M) & (offs_bn[None, :] < N)
+        if HAS_BIAS:
+            bias = tl.load(bias_ptr + offs_bn, mask=offs_bn < N, other=0.0)
+            accumulator += bias[None, :].to(tl.float32)
+        if ACTIVATION == "relu":
+            accumulator = tl.maximum(accumulator, 0.0)
+        elif ACTIVATION == "gelu":
+            accumulator = 0.5 * accumulator * (1 + tl.erf(accumulator * 0.7071067811865476))
+        if HAS_RESIDUAL:
+            residual = tl.load(residual_ptr + offs_am[:, None] * stride_rm + offs_bn[None, :] * stride_rn,
+                               mask=mask_c, other=0.0)
+            accumulator += residual.to(tl.float32)
+        c_ptrs = c_ptr + offs_am[:, None] * stride_cm + offs_bn[None, :] * stride_cn
+        tl.store(c_ptrs, accumulator, mask=mask_c)
+
+# 4. CPU implementations: NumPy's BLAS-backed matmul and a blocked (tiled) NumPy matmul
+def blocked_matmul(a, b, block_m, block_n, block_k):
+    # Same tiling as the GPU kernels, each (block_m x block_k) @ (block_k x block_n) tile product
+    # accumulates into its output tile so the working set of one step stays cache resident
+    M, K = a.shape
+    N = b.shape[1]
+    c = np.zeros((M, N), dtype=np.result_type(a, b))
+    for i in range(0, M, block_m):
+        for j in range(0, N, block_n):
+            c_tile = c[i:i + block_m, j:j + block_n]
+            for k in range(0, K, block_k):
+                c_tile += a[i:i + block_m, k:k + block_k] @ b[k:k + block_k, j:j + block_n]
+    return c
+
+def apply_epilogue_(tile, bias=None, activation=None, residual=None):
+    # In place on a torch tensor (or a torch view of a NumPy tile), bias and residual already sliced to the tile
+    if bias is not None:
+        tile += bias
+    if activation == "relu":
+        tile.relu_()
+    elif activation == "gelu":
+        tile.copy_(torch.nn.functional.gelu(tile))
+    if residual is not None:
+        tile += residual
+    return tile
+
+def blocked_matmul_epilogue(a, b, block_m, block_n, block_k, bias=None, activation=None, residual=None):
+    # blocked_matmul finishing each output tile with the epilogue while it is still in cache
+    M, K = a.shape
+    N = b.shape[1]
+    c = np.zeros((M, N), dtype=np.result_type(a, b))
+    for i in range(0, M, block_m):
+        for j in range(0, N, block_n):
+            c_tile = c[i:i + block_m, j:j + block_n]
+            for k in range(0, K, block_k):
+                c_tile += a[i:i + block_m, k:k + block_k] @ b[k:k + block_k, j:j + block_n]
+            apply_epilogue_(
+                torch.from_numpy(c_tile),
+                None if bias is None else torch.from_numpy(bias[j:j + block_n]),
+                activation,
+                None if residual is None else torch.from_numpy(residual[i:i + block_m, j:j + block_n]),
             )
-            end.record()
-            torch.cuda.synchronize()
-            triton_times.append(start.elapsed_time(end))
-            
-            # Verify every 10 iterations
-            if i % 10 == 0:
-                try:
-                    assert torch.allclose(c_triton, reference, rtol=RTOL, atol=ATOL), \
-                        f"Triton result mismatch at iteration {i}"
-                except AssertionError as e:
-                    print(f"Triton verification failed at iteration {i}")
-                    max_diff = torch.max(torch.abs(reference - c_triton))
-                    print(f"Maximum absolute difference: {max_diff.item()}")
-                    triton_times = []  # Invalidate results
-                    break
-
-        # Print results only if all implementations passed verification
-        if pytorch_times and cuda_times and triton_times:
-            def print_stats(name, times):
-                mean = np.mean(times)
-                std = np.std(times)
-                tflops = 2 * M * N * K * 1e-12 / (mean * 1e-3)
-                print(f"{name:>10} - Mean: {mean:>8.2f} ms (±{std:>6.2f}), {tflops:>6.2f} TFLOPS")
-
-            print("\nResults:")
-            print_stats("PyTorch", pytorch_times)
-            print_stats("CUDA", cuda_times)
-            print_stats("Triton", triton_times)
-        else:
-            print("\nBenchmark skipped due to verification failures")
+    return c
+
+# (M, N, K) -> best (block_m, block_n, block_k) found by autotune_blocked_matmul
+BLOCK_SIZE_CACHE = {}
+BLOCK_SIZE_CANDIDATES = [64, 128, 256, 512]
+
+def autotune_blocked_matmul(a, b, candidates=BLOCK_SIZE_CANDIDATES, repeats=3):
+    # Times every block size combination that fits the shape and keeps the fastest per (M, N, K)
+    M, K = a.shape
+    N = b.shape[1]
+    if (M, N, K) in BLOCK_SIZE_CACHE:
+        return BLOCK_SIZE_CACHE[(M, N, K)]
+
+    def sizes_for(dim):
+        # Blocks at least as large as the dimension all behave like one block, only try the smallest
+        larger = [size for size in candidates if size >= dim]
+        return [size for size in candidates if size < dim] + larger[:1]
+
+    best_time, best_config = float("inf"), None
+    for config in itertools.product(sizes_for(M), sizes_for(N), sizes_for(K)):
+        blocked_matmul(a, b, *config)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            blocked_matmul(a, b, *config)
+        elapsed = (time.perf_counter() - start) / repeats
+        if elapsed < best_time:
+            best_time, best_config = elapsed, config
+    BLOCK_SIZE_CACHE[(M, N, K)] = best_config
+    return best_config
+
+# Benchmark registrations: the matmul (M, N, K) and batched bmm (B, M, N, K) suites, then one
+# kernel per implementation and device
+BLOCK_SIZE = 32
+
+# Shapes from a 7B-class decoder (hidden 4096, MLP 11008, 32 heads of 128) rather than cubes only
+HIDDEN, FFN, HEADS, HEAD_DIM = 4096, 11008, 32, 128
+SHAPE_SUITES = {
+    "cube": [(1024, 1024, 1024), (2048, 2048, 2048), (4096, 4096, 4096)],
+    # Decode: M tokens in flight through a projection, tall-skinny and weight-bandwidth bound
+    "decode": [(m, HIDDEN, HIDDEN) for m in (1, 2, 4, 8, 16, 32, 64)],
+    # Prefill chunks through the MLP up and down projections
+    "ffn": [(512, FFN, HIDDEN), (512, HIDDEN, FFN), (64, FFN, HIDDEN)],
+    # DecoderLayer.ffn in Agent/MoE/transformer-lite.py (d_model 512, d_ff 2048): its example batch of
+    # 32 x 20 tokens and a 32 sequence decode step, through the up and the down projection
+    "mlp": [(640, 2048, 512), (640, 512, 2048), (32, 2048, 512), (32, 512, 2048)],
+    # Attention per (batch x head): QK^T and PV for a 512 token prefill and a decode step over 2048 cached tokens
+    "attention": [(HEADS, 512, 512, HEAD_DIM), (HEADS, 512, HEAD_DIM, 512),
+                  (HEADS, 1, 2048, HEAD_DIM), (HEADS, 1, HEAD_DIM, 2048)],
+}
+
+def make_matmul_inputs(shape, dtype):
+    M, N, K = shape
+    torch.manual_seed(0)
+    # Use smaller values to reduce numerical errors
+    return {"a": torch.randn(M, K, dtype=dtype) * 0.01, "b": torch.randn(K, N, dtype=dtype) * 0.01}
+
+def make_bmm_inputs(shape, dtype):
+    B, M, N, K = shape
+    torch.manual_seed(0)
+    return {"a": torch.randn(B, M, K, dtype=dtype) * 0.01, "b": torch.randn(B, K, N, dtype=dtype) * 0.01}
+
+kernel_bench.register_suite(
+    "matmul",
+    make_inputs=make_matmul_inputs,
+    reference=lambda inputs: torch.mm(inputs["a"].double(), inputs["b"].double()),
+    flops=lambda shape: 2 * shape[0] * shape[1] * shape[2],
+    # Each operand read once and the output written once, the best any kernel can do
+    traffic=lambda shape, itemsize: (shape[0] * shape[2] + shape[2] * shape[1] + shape[0] * shape[1]) * itemsize,
+)
+kernel_bench.register_suite(
+    "bmm",
+    make_inputs=make_bmm_inputs,
+    reference=lambda inputs: torch.bmm(inputs["a"].double(), inputs["b"].double()),
+    flops=lambda shape: 2 * shape[0] * shape[1] * shape[2] * shape[3],
+    traffic=lambda shape, itemsize: shape[0] * (shape[1] * shape[3] + shape[3] * shape[2] + shape[1] * shape[2]) * itemsize,
+)
+
+def suite_for(shape):
+    return "bmm" if len(shape) == 4 else "matmul"
+
+def to_numpy(inputs):
+    return {name: tensor.numpy() for name, tensor in inputs.items()}
+
+def setup_blocked(inputs):
+    state = to_numpy(inputs)
+    state["block_sizes"] = autotune_blocked_matmul(state["a"], state["b"])
+    print(f"Best block sizes (M, N, K): {state['block_sizes']}")
+    return state
+
+# NumPy has no bfloat16 and no BLAS path for float16, so the NumPy kernels only run in float32
+kernel_bench.register_kernel("matmul", "torch.mm", lambda state: torch.mm(state["a"], state["b"]))
+kernel_bench.register_kernel("matmul", "NumPy", lambda state: state["a"] @ state["b"], setup=to_numpy, dtypes=("float32",))
+kernel_bench.register_kernel("matmul", "Blocked", lambda state: blocked_matmul(state["a"], state["b"], *state["block_sizes"]),
+                             setup=setup_blocked, dtypes=("float32",))
+kernel_bench.register_kernel("bmm", "torch.bmm", lambda state: torch.bmm(state["a"], state["b"]))
+kernel_bench.register_kernel("bmm", "NumPy", lambda state: np.matmul(state["a"], state["b"]), setup=to_numpy, dtypes=("float32",))
+
+def to_cuda(inputs):
+    return {name: tensor.cuda() for name, tensor in inputs.items()}
+
+# 1. PyTorch Implementation
+kernel_bench.register_kernel("matmul", "PyTorch", lambda state: MatmulCUDAFunction.apply(state["a"], state["b"]),
+                             setup=to_cuda, device="cuda")
+kernel_bench.register_kernel("bmm", "PyTorch", lambda state: torch.bmm(state["a"], state["b"]), setup=to_cuda, device="cuda")
+
+# 2. CUDA Implementation
+_pycuda_module = None
+
+def pycuda_module():
+    # Compiled once, nvcc takes far longer than any single run
+    global _pycuda_module
+    if _pycuda_module is None:
+        _pycuda_module = SourceModule(cuda_kernel)
+    return _pycuda_module
+
+def setup_pycuda(inputs):
+    mod = pycuda_module()
+    a_cpu = inputs["a"].numpy()
+    b_cpu = inputs["b"].numpy()
+    M, K = a_cpu.shape
+    N = b_cpu.shape[1]
+    state = {"kernel": mod.get_function("matmul_kernel_optimized"), "M": M, "N": N, "K": K,
+             "c_cpu": np.empty((M, N), dtype=np.float32)}
+
+    # Allocate memory
+    state["a_gpu"] = cuda.mem_alloc(a_cpu.nbytes)
+    state["b_gpu"] = cuda.mem_alloc(b_cpu.nbytes)
+    state["c_gpu"] = cuda.mem_alloc(state["c_cpu"].nbytes)
+    cuda.memcpy_htod(state["a_gpu"], a_cpu)
+    cuda.memcpy_htod(state["b_gpu"], b_cpu)
+    return state
+
+def run_pycuda(state):
+    M, N, K = state["M"], state["N"], state["K"]
+    state["kernel"](
+        state["a_gpu"], state["b_gpu"], state["c_gpu"],
+        np.int32(M), np.int32(N), np.int32(K),
+        block=(BLOCK_SIZE, BLOCK_SIZE, 1),
+        grid=((N + BLOCK_SIZE - 1) // BLOCK_SIZE,
+             (M + BLOCK_SIZE - 1) // BLOCK_SIZE)
+    )
+    # pycuda.autoinit has its own context, torch.cuda.synchronize does not wait for it
+    cuda.Context.synchronize()
+
+def fetch_pycuda(state, result):
+    cuda.memcpy_dtoh(state["c_cpu"], state["c_gpu"])
+    return state["c_cpu"]
+
+kernel_bench.register_kernel("matmul", "CUDA", run_pycuda, setup=setup_pycuda, device="cuda",
+                             available=lambda: cuda is not None, fetch=fetch_pycuda, dtypes=("float32",))
+
+# 3. Triton Implementation
+def triton_matmul(a, b, c, block_size=BLOCK_SIZE, input_precision="tf32"):
+    # Any strides work, the kernel addresses every operand through its stride arguments
+    M, K = a.shape
+    N = b.shape[1]
+    grid = (triton.cdiv(M, block_size) * triton.cdiv(N, block_size),)
+    matmul_kernel_optimized[grid](
+        a_ptr=a, b_ptr=b, c_ptr=c,
+        M=M, N=N, K=K,
+        BLOCK_SIZE_M=block_size,
+        BLOCK_SIZE_N=block_size,
+        BLOCK_SIZE_K=block_size,
+        stride_am=a.stride(0), stride_ak=a.stride(1),
+        stride_bk=b.stride(0), stride_bn=b.stride(1),
+        stride_cm=c.stride(0), stride_cn=c.stride(1),
+        INPUT_PRECISION=input_precision,
+    )
+    return c
+
+def ieee_triton_matmul(a, b, c):
+    # Full float32 products, TF32 (10 mantissa bits) misses the fuzzer's 1e-3 tolerance on GPUs
+    return triton_matmul(a, b, c, input_precision="ieee")
+
+def setup_triton(inputs):
+    state = to_cuda(inputs)
+    M, K = state["a"].shape
+    N = state["b"].shape[1]
+    state["c"] = torch.empty((M, N), device='cuda', dtype=state["a"].dtype)
+    return state
+
+def setup_triton_interpreted(inputs):
+    M, K = inputs["a"].shape
+    N = inputs["b"].shape[1]
+    # The interpreter executes each program instance in Python, fine for CI shapes and far too slow beyond
+    if M * N * K > INTERPRET_MAX_MNK:
+        raise ValueError(f"{M}x{N}x{K} is too large for the Triton interpreter")
+    return {**inputs, "c": torch.empty((M, N), dtype=inputs["a"].dtype)}
+
+def run_triton(state):
+    return triton_matmul(state["a"], state["b"], state["c"])
+
+# The triton kernel accumulates in float32 and tl.store casts to the output dtype
+kernel_bench.register_kernel("matmul", "Triton", run_triton, setup=setup_triton, device="cuda",
+                             available=lambda: load_triton() is not None and not INTERPRET, dtypes=("float32", "float16", "bfloat16"))
+# NumPy backs the interpreter, so no bfloat16
+INTERPRET_MAX_MNK = 256 ** 3
+kernel_bench.register_kernel("matmul", "Triton", run_triton, setup=setup_triton_interpreted, device="cpu",
+                             available=lambda: load_triton() is not None and INTERPRET, dtypes=("float32", "float16"))
+
+# Fused epilogues: one "linear_<epilogue>" suite per variant over (M, N, K) shapes. DecoderLayer.ffn is
+# Linear -> ReLU -> Linear followed by the residual add, i.e. bias_relu then bias_residual
+EPILOGUES = {
+    "bias": {"bias": True, "activation": None, "residual": False},
+    "bias_relu": {"bias": True, "activation": "relu", "residual": False},
+    "bias_gelu": {"bias": True, "activation": "gelu", "residual": False},
+    "bias_residual": {"bias": True, "activation": None, "residual": True},
+    "bias_relu_residual": {"bias": True, "activation": "relu", "residual": True},
+}
+
+def make_linear_inputs(epilogue):
+    def make_inputs(shape, dtype):
+        M, N, K = shape
+        inputs = make_matmul_inputs(shape, dtype)
+        if epilogue["bias"]:
+            inputs["bias"] = torch.randn(N, dtype=dtype) * 0.01
+        if epilogue["residual"]:
+            inputs["residual"] = torch.randn(M, N, dtype=dtype) * 0.01
+        return inputs
+    return make_inputs
+
+def unfused_linear(state, epilogue):
+    # What nn.Linear, the activation module and the residual add do in eager mode: every op makes a new tensor
+    y = torch.mm(state["a"], state["b"])
+    if epilogue["bias"]:
+        y = y + state["bias"]
+    if epilogue["activation"] == "relu":
+        y = torch.relu(y)
+    elif epilogue["activation"] == "gelu":
+        y = torch.nn.functional.gelu(y)
+    if epilogue["residual"]:
+        y = y + state["residual"]
+    return y
+
+def addmm_linear(state, epilogue):
+    # The bias folded into the GEMM as nn.Linear does it, the rest in place on its output
+    y = torch.addmm(state["bias"], state["a"], state["b"]) if epilogue["bias"] else torch.mm(state["a"], state["b"])
+    return apply_epilogue_(y, activation=epilogue["activation"], residual=state.get("residual"))
+
+def linear_traffic(epilogue, unfused_ops=0):
+    # Fused: operands, bias and residual read once, output written once. Every epilogue op run as its
+    # own pass adds a read and a write of the M x N intermediate
+    def traffic(shape, itemsize):
+        M, N, K = shape
+        elements = M * K + K * N + M * N + N * epilogue["bias"] + M * N * epilogue["residual"]
+        return (elements + 2 * M * N * unfused_ops) * itemsize
+    return traffic
+
+def setup_blocked_epilogue(inputs):
+    state = setup_blocked({"a": inputs["a"], "b": inputs["b"]})
+    state.update({name: inputs[name].numpy() for name in ("bias", "residual") if name in inputs})
+    return state
+
+def triton_matmul_epilogue(a, b, c, epilogue, bias=None, residual=None, block_size=BLOCK_SIZE):
+    M, K = a.shape
+    N = b.shape[1]
+    grid = (triton.cdiv(M, block_size) * triton.cdiv(N, block_size),)
+    # Unused pointers still need a tensor argument, the constexpr flags keep them from being read
+    residual_arg = residual if residual is not None else c
+    matmul_epilogue_kernel[grid](
+        a, b, c, bias if bias is not None else c, residual_arg,
+        M, N, K,
+        a.stride(0), a.stride(1),
+        b.stride(0), b.stride(1),
+        c.stride(0), c.stride(1),
+        residual_arg.stride(0), residual_arg.stride(1),
+        BLOCK_SIZE_M=block_size, BLOCK_SIZE_N=block_size, BLOCK_SIZE_K=block_size,
+        HAS_BIAS=bias is not None, ACTIVATION=epilogue["activation"] or "none", HAS_RESIDUAL=residual is not None,
+    )
+    return c
+
+def register_epilogue(name, epilogue):
+    suite = f"linear_{name}"
+    flops = lambda shape: 2 * shape[0] * shape[1] * shape[2]
+    kernel_bench.register_suite(
+        suite,
+        make_inputs=make_linear_inputs(epilogue),
+        reference=lambda inputs: unfused_linear({key: tensor.double() for key, tensor in inputs.items()}, epilogue),
+        flops=flops,
+        traffic=linear_traffic(epilogue),
+    )
+    ops = epilogue["bias"] + (epilogue["activation"] is not None) + epilogue["residual"]
+    for kernel_name, run, traffic in (("unfused", unfused_linear, linear_traffic(epilogue, ops)),
+                                      ("addmm", addmm_linear, linear_traffic(epilogue, ops - epilogue["bias"]))):
+        run_epilogue = lambda state, run=run: run(state, epilogue)
+        kernel_bench.register_kernel(suite, kernel_name, run_epilogue, traffic=traffic)
+        kernel_bench.register_kernel(suite, kernel_name, run_epilogue, setup=to_cuda, device="cuda", traffic=traffic)
+    blocked = lambda state: blocked_matmul_epilogue(state["a"], state["b"], *state["block_sizes"], bias=state.get("bias"),
+                                                    activation=epilogue["activation"], residual=state.get("residual"))
+    kernel_bench.register_kernel(suite, "Blocked", blocked, setup=setup_blocked_epilogue, dtypes=("float32",))
+    fused = lambda state: triton_matmul_epilogue(state["a"], state["b"], state["c"], epilogue,
+                                                 state.get("bias"), state.get("residual"))
+    kernel_bench.register_kernel(suite, "Triton", fused, setup=setup_triton, device="cuda",
+                                 available=lambda: load_triton() is not None and not INTERPRET, dtypes=("float32", "float16", "bfloat16"))
+    kernel_bench.register_kernel(suite, "Triton", fused, setup=setup_triton_interpreted, device="cpu",
+                                 available=lambda: load_triton() is not None and INTERPRET, dtypes=("float32", "float16"))
+
+for name, epilogue in EPILOGUES.items():
+    register_epilogue(name, epilogue)
+
+def benchmark_fused(sizes=None, device="cpu", epilogues=None, num_warmup=3, num_iterations=10, kernels=None, dtypes=("float32",)):
+    print(f"Starting fused epilogue benchmark on {device}...")
+    sizes = sizes or SHAPE_SUITES["mlp"]
+    results = []
+    for name in epilogues or EPILOGUES:
+        results += kernel_bench.run_suite(f"linear_{name}", sizes, dtypes=dtypes, device=device, kernels=kernels,
+                                          warmup=num_warmup, iterations=num_iterations)
+    return results
+
+def print_fusion_report(results):
+    # Against the unfused torch baseline of the same shape: memory traffic saved and time saved
+    baselines = {kernel_bench.result_key(result)[:1] + kernel_bench.result_key(result)[2:]: result
+                 for result in results if result["kernel"] == "unfused" and result["status"] == "ok"}
+    print("\nFusion vs unfused torch:")
+    for result in results:
+        key = kernel_bench.result_key(result)
+        base = baselines.get(key[:1] + key[2:])
+        if base is None or result["kernel"] == "unfused" or result["status"] != "ok":
+            continue
+        saved = base["bytes"] - result["bytes"]
+        print(f"{key[0]:<26} {key[3]:<14} {key[4]:<9} {key[1]:<8} saves {saved / 2 ** 20:>8.2f} MB "
+              f"({saved / base['bytes']:>5.1%} of traffic), {base['median_ms'] / result['median_ms']:>5.2f}x speed")
+
+# Correctness fuzzing: random shapes around the block size with contiguous, transposed and sliced operands
+LAYOUTS = ("contiguous", "transposed", "sliced")
+
+def make_operand(rows, cols, layout, generator, dtype=torch.float32, device="cpu"):
+    if layout == "transposed":
+        # Column-major view: unit stride along rows
+        tensor = torch.randn(cols, rows, generator=generator).t()
+    elif layout == "sliced":
+        # Row stride wider than the row, so reading past a row lands on data that must stay masked out
+        tensor = torch.randn(rows, cols + 7, generator=generator)[:, :cols]
+    else:
+        tensor = torch.randn(rows, cols, generator=generator)
+    # .to keeps the strides of a non-contiguous view
+    return tensor.to(device=device, dtype=dtype)
+
+def fuzz_dim(rng, max_dim, block_size=BLOCK_SIZE):
+    # Half the draws land on the edges of a block, where the boundary masks matter
+    if rng.random() < 0.5:
+        return rng.choice([1, block_size - 1, block_size, block_size + 1, 2 * block_size - 1, 2 * block_size + 1])
+    return rng.randint(1, max_dim)
+
+def fuzz_matmul(run, trials=100, max_dim=96, seed=0, layouts=LAYOUTS, device="cpu", dtype=torch.float32, rtol=1e-3, atol=1e-3):
+    # run(a, b, c) writes a @ b into c (or returns it); returns the failing cases
+    rng = random.Random(seed)
+    generator = torch.Generator().manual_seed(seed)
+    failures = []
+    for trial in range(trials):
+        M, N, K = (fuzz_dim(rng, max_dim) for _ in range(3))
+        layout_a, layout_b, layout_c = (rng.choice(layouts) for _ in range(3))
+        a = make_operand(M, K, layout_a, generator, dtype, device)
+        b = make_operand(K, N, layout_b, generator, dtype, device)
+        c = make_operand(M, N, layout_c, generator, dtype, device).fill_(float("nan"))
+        expected = torch.mm(a.cpu().double(), b.cpu().double())
+        try:
+            output = run(a, b, c)
+            actual = kernel_bench.as_cpu_tensor(output if output is not None else c)
+            ok = actual.shape == expected.shape and torch.allclose(actual, expected, rtol=rtol, atol=atol)
+            error = None if ok else f"max abs diff {(actual - expected).abs().max().item():.3g}"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        if error is not None:
+            failures.append({"trial": trial, "shape": (M, N, K), "layouts": (layout_a, layout_b, layout_c), "error": error})
+    return failures
+
+def pycuda_matmul(a, b, c):
+    # The CUDA kernel indexes row-major operands, fuzz it with contiguous layouts only
+    state = setup_pycuda({"a": a.cpu(), "b": b.cpu()})
+    run_pycuda(state)
+    return fetch_pycuda(state, None)
+
+def run_fuzz(trials, seed=0):
+    targets = []
+    if load_triton() is not None and (INTERPRET or torch.cuda.is_available()):
+        targets.append(("Triton (interpreter)" if INTERPRET else "Triton", ieee_triton_matmul, LAYOUTS, "cpu" if INTERPRET else "cuda"))
+    if cuda is not None:
+        targets.append(("CUDA", pycuda_matmul, ("contiguous",), "cpu"))
+    if not targets:
+        print("Nothing to fuzz: needs triton with a CUDA device or --interpret, or pycuda")
+        return None
+    passed = True
+    for name, run, layouts, device in targets:
+        failures = fuzz_matmul(run, trials, seed=seed, layouts=layouts, device=device)
+        print(f"{name}: {trials - len(failures)}/{trials} random shapes passed")
+        for failure in failures:
+            print(f"  trial {failure['trial']} {kernel_bench.shape_name(failure['shape'])} {'/'.join(failure['layouts'])}: {failure['error']}")
+        passed = passed and not failures
+    return passed
+
+def run_shapes(sizes, device, dtypes=("float32",), kernels=None, **options):
+    # Consecutive shapes of the same suite run together, so the output keeps the order they were given in
+    results = []
+    for suite, group in itertools.groupby(sizes, key=suite_for):
+        results += kernel_bench.run_suite(suite, list(group), dtypes=dtypes, device=device, kernels=kernels, **options)
+    return results
+
+def benchmark_cpu(sizes=None, num_warmup=3, num_iterations=10, kernels=None, dtypes=("float32",)):
+    print("Starting CPU benchmark comparison...")
+    sizes = sizes or [
+        (256, 256, 256),
+        (512, 512, 512),
+        (1024, 1024, 1024)
+    ]
+    return run_shapes(sizes, "cpu", dtypes, kernels, warmup=num_warmup, iterations=num_iterations)
+
+def benchmark_comparison(sizes=None, num_warmup=20, num_iterations=100, kernels=None, dtypes=("float32",)):
+    print("Starting benchmark comparison...")
+    # Test different matrix sizes
+    sizes = sizes or SHAPE_SUITES["cube"]
+    return run_shapes(sizes, "cuda", dtypes, kernels, warmup=num_warmup, iterations=num_iterations)
 
 if __name__ == "__main__":
-    benchmark_comparison()
+    parser = argparse.ArgumentParser(description="Matmul benchmark: PyTorch/CUDA/Triton on GPU, torch/NumPy/blocked NumPy on CPU")
+    parser.add_argument("--device", choices=["auto", "cpu", "cuda"], default="auto",
+                        help="auto runs the GPU comparison when a CUDA device is present, the CPU one otherwise")
+    parser.add_argument("--sizes", nargs="+", default=[], metavar="MxNxK",
+                        help="matrix sizes, e.g. 512x512x512, or BxMxNxK for a batched bmm, e.g. 32x1x2048x128")
+    parser.add_argument("--suites", nargs="+", default=[], choices=sorted(SHAPE_SUITES), help="named shape suites to add to --sizes")
+    parser.add_argument("--dtypes", nargs="+", default=["float32"], choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--peaks", nargs=2, type=float, default=None, metavar=("TFLOPS", "GBPS"),
+                        help="machine peak throughput and bandwidth for the roofline instead of measuring them")
+    parser.add_argument("--kernels", nargs="+", default=None, help="only run these kernels")
+    parser.add_argument("--warmup", type=int, default=None)
+    parser.add_argument("--iterations", type=int, default=None)
+    parser.add_argument("--fused", nargs="*", default=None, choices=sorted(EPILOGUES), metavar="EPILOGUE",
+                        help=f"benchmark matmul with fused epilogues ({', '.join(EPILOGUES)}, all by default) "
+                             "against unfused torch on the mlp shapes")
+    parser.add_argument("--interpret", action="store_true",
+                        help="run the Triton kernel on CPU under TRITON_INTERPRET=1, for small shapes")
+    parser.add_argument("--fuzz", type=int, default=0, metavar="TRIALS",
+                        help="check the Triton and CUDA kernels on random shapes and strides instead of benchmarking, "
+                             "exits 1 on a mismatch or when no backend can run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="write results to this .json or .csv file")
+    parser.add_argument("--baseline", default=None, help="compare against this results file, exit 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=0.05, help="relative median slowdown counted as a regression")
+    args = parser.parse_args()
+    load_triton(interpret=args.interpret)
+    if args.fuzz:
+        # A fuzz that found no backend to run did not pass either
+        sys.exit(0 if run_fuzz(args.fuzz, args.seed) else 1)
+    device = args.device
+    if device == "auto":
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    sizes = [tuple(int(dim) for dim in size.split("x")) for size in args.sizes]
+    sizes += [shape for name in args.suites for shape in SHAPE_SUITES[name]]
+    if args.peaks:
+        for dtype in args.dtypes:
+            kernel_bench.set_peaks(device, dtype, *args.peaks)
+    options = {name: value for name, value in (("num_warmup", args.warmup), ("num_iterations", args.iterations)) if value is not None}
+    if args.fused is not None:
+        results = benchmark_fused([size for size in sizes if len(size) == 3] or None, device, args.fused,
+                                  kernels=args.kernels, dtypes=args.dtypes, **options)
+    elif device == "cuda":
+        results = benchmark_comparison(sizes or None, kernels=args.kernels, dtypes=args.dtypes, **options)
+    else:
+        results = benchmark_cpu(sizes or None, kernels=args.kernels, dtypes=args.dtypes, **options)
+    kernel_bench.print_best(results)
+    if args.fused is not None:
+        print_fusion_report(results)
+    if args.output:
+        kernel_bench.write_results(results, args.output)
+    if args.baseline and not kernel_bench.check_regressions(results, args.baseline, args.threshold):
+        sys.exit(1)